@@ -0,0 +1,55 @@
+# Converts the .json regressors in the addon data folder to binary NumPy files.
+#
+# For every regressor <name>.json this writes one <name>_<key>.npy file per array, which the addon
+# memory-maps on load (see meshcapade_addon/regressors.py). With --npz a single uncompressed <name>.npz
+# is written instead; .npz members cannot be memory-mapped, but it still skips the JSON parser.
+#
+# usage: python build/convert_regressors.py [--data-folder DIR] [--npz] [--force]
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+
+build_script_dir = Path(__file__).parent
+default_data_folder = build_script_dir.parent / "meshcapade_addon" / "data"
+
+# Regressor file name pattern and the arrays stored in it
+REGRESSOR_KEYS = {
+    "*_betas_to_joints_*.json": ("betasJ_regr", "template_J"),
+    "measurements_to_betas_*.json": ("A", "B"),
+}
+
+parser = argparse.ArgumentParser(description="Convert .json regressors to binary .npy/.npz files")
+parser.add_argument("--data-folder", type=Path, default=default_data_folder)
+parser.add_argument("--npz", action="store_true", help="write one .npz per regressor instead of .npy files")
+parser.add_argument("--force", action="store_true", help="overwrite existing binary files")
+args = parser.parse_args()
+
+num_converted = 0
+for pattern, keys in REGRESSOR_KEYS.items():
+    for json_path in sorted(args.data_folder.glob(pattern)):
+        if args.npz:
+            output_paths = [json_path.with_suffix(".npz")]
+        else:
+            output_paths = [json_path.with_name(f"{json_path.stem}_{key}.npy") for key in keys]
+
+        if not args.force and all(path.exists() for path in output_paths):
+            print("Skipping '{}', already converted".format(json_path))
+            continue
+
+        with open(json_path) as f:
+            data = json.load(f)
+        arrays = {key: np.asarray(data[key], dtype=np.float64) for key in keys}
+
+        if args.npz:
+            np.savez(output_paths[0], **arrays)
+        else:
+            for key, output_path in zip(keys, output_paths):
+                np.save(output_path, arrays[key])
+
+        for output_path in output_paths:
+            print("Wrote '{}'".format(output_path))
+        num_converted += 1
+
+print("Finished converting {} regressors in '{}'".format(num_converted, args.data_folder))
@@ -0,0 +1,102 @@
+# Unattended conversion of .npz motion files to .fbx/.obj.
+#
+# Used by scripts/batch_convert.py, which runs this inside a background Blender instance:
+#   blender -b -P scripts/batch_convert.py -- --input <dir or manifest> --output-dir <dir>
+import bpy
+import json
+import os
+import time
+import traceback
+
+from .blender import (
+    export_avatar,
+)
+from .globals import (
+    EXPORT_TYPE,
+)
+from .manifest import (
+    output_path_for,
+)
+from .scheduler import (
+    suspend_joint_updates,
+)
+from .templates import (
+    get_template_collection,
+)
+
+
+def reset_scene():
+    # Removes the avatars and animations of the previous conversion, so that every file starts from the same state.
+    # The avatar templates are kept, so the model files are only read once per batch, and so are the shared
+    # materials and their texture images (see materials.py), so the textures are only decoded once per batch.
+    if bpy.context.active_object is not None and bpy.context.active_object.mode != 'OBJECT':
+        bpy.ops.object.mode_set(mode='OBJECT')
+
+    template_collection = get_template_collection()
+    bpy.data.batch_remove([obj for obj in bpy.data.objects if obj.name not in template_collection.objects])
+    bpy.data.batch_remove(list(bpy.data.actions))
+
+    # Only the mesh and armature data of the removed avatars, their shape keys are removed with the meshes
+    bpy.data.batch_remove([data for data in list(bpy.data.meshes) + list(bpy.data.armatures) if data.users == 0])
+
+    scene = bpy.context.scene
+    scene.frame_start = 1
+    scene.frame_end = 1
+    scene.frame_set(1)
+
+
+def convert_file(input_path, output_path, export_type, load_options, export_options=None):
+    reset_scene()
+
+    # Load Avatar sets the joint locations itself, shape key notifications must not trigger another update
+    with suspend_joint_updates(defer=False):
+        result = bpy.ops.object.load_avatar('EXEC_DEFAULT', filepath=input_path, **load_options)
+    if 'FINISHED' not in result:
+        raise RuntimeError(f"Loading failed: {result}")
+
+    obj = bpy.context.view_layer.objects.active
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    export_avatar(obj, output_path, export_type, **(export_options or {}))
+
+    if not os.path.exists(output_path):
+        raise RuntimeError(f"Exporter did not write {output_path}")
+
+
+def convert_files(inputs, output_dir, export_type=EXPORT_TYPE.FBX.value, load_options=None, export_options=None,
+                  skip_existing=False, results_path=None):
+    # Converts all (input_path, input_root) entries and returns one result dict per file.
+    # A failing file does not stop the batch. With results_path every result is appended as one json line
+    # as soon as the file is done.
+    load_options = load_options or {}
+    results = []
+
+    for index, (input_path, input_root) in enumerate(inputs):
+        output_path = output_path_for(input_path, input_root, output_dir, export_type)
+        print(f"[{index + 1}/{len(inputs)}] {input_path} -> {output_path}")
+
+        result = {
+            "input": input_path,
+            "output": output_path,
+        }
+
+        start_time = time.time()
+        if skip_existing and os.path.exists(output_path):
+            result["status"] = "skipped"
+        else:
+            try:
+                convert_file(input_path, output_path, export_type, load_options, export_options)
+                result["status"] = "ok"
+            except Exception as error:
+                traceback.print_exc()
+                result["status"] = "failed"
+                result["error"] = str(error)
+        result["seconds"] = round(time.time() - start_time, 3)
+
+        results.append(result)
+        if results_path is not None:
+            with open(results_path, "a") as f:
+                f.write(json.dumps(result) + "\n")
+
+    reset_scene()
+    return results
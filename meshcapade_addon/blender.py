@@ -1,8 +1,33 @@
 import bpy
 
-from mathutils import Vector, Quaternion
+from contextlib import contextmanager
+from mathutils import Quaternion
 from math import radians
+import numpy as np
 import os
+import re
+
+from .body_model import (
+    BodyModel,
+)
+from .correctives import (
+    pose_corrective_weights,
+)
+from .globals import (
+    EXPORT_TYPE,
+    MODEL_JOINT_NAMES,
+)
+from .gltf import (
+    GLTFBuilder,
+)
+from .rotations import (
+    euler_to_mat,
+    rodrigues_to_quat,
+    quat_continuous,
+    quat_to_mat,
+    quat_to_rodrigues,
+    mat_to_quat,
+)
 
 def setup_bone(bone, SMPL_version):
     # TODO add SMPLH support
@@ -11,6 +36,67 @@ def setup_bone(bone, SMPL_version):
         bone.tail = (0.0, 10, 0)
 
 
+# Joints that moved less than this [Blender units] are regarded as unchanged
+JOINT_LOCATION_TOLERANCE = 1e-4
+
+
+def moved_joints(armature, joint_names, joint_locations):
+    # Compares the rest positions of the bones with the (num_joints, 3) joint locations [m] from the joint
+    # regressor. Returns (moved, heads, tails): the mask of the joints that moved by more than the tolerance
+    # and the bone heads and tails of the joint locations.
+    # Convert joint locations to Blender joint locations, see setup_bone() for the bone orientation
+    heads = np.asarray(joint_locations, dtype=np.float64)[:len(joint_names)] * 100
+    tails = heads + (0.0, 10, 0)
+
+    bones = armature.data.bones
+    bone_indices = np.array([bones.find(joint_name) for joint_name in joint_names])
+    current_heads = np.empty((len(bones), 3), dtype=np.float32)
+    current_tails = np.empty((len(bones), 3), dtype=np.float32)
+    bones.foreach_get("head_local", current_heads.ravel())
+    bones.foreach_get("tail_local", current_tails.ravel())
+
+    moved = (np.abs(current_heads[bone_indices] - heads).max(axis=1) > JOINT_LOCATION_TOLERANCE) | \
+            (np.abs(current_tails[bone_indices] - tails).max(axis=1) > JOINT_LOCATION_TOLERANCE)
+    return (moved, heads, tails)
+
+
+def set_joint_locations(armature, joint_names, joint_locations, SMPL_version):
+    # Moves the bones to the (num_joints, 3) joint locations [m] from the joint regressor.
+    # Rest positions can only be written to edit bones, so edit mode is only entered if a joint moved by more
+    # than the tolerance. Only the moved bones are changed, with one foreach_set for all heads and one for all
+    # tails instead of setting up and translating every bone. Returns True if the bones were changed.
+    # TODO add SMPLH support
+    if SMPL_version not in ['SMPLX', 'SUPR']:
+        return False
+
+    (moved, heads, tails) = moved_joints(armature, joint_names, joint_locations)
+    if not moved.any():
+        return False
+
+    previous_active = bpy.context.view_layer.objects.active
+    bpy.context.view_layer.objects.active = armature
+    bpy.ops.object.mode_set(mode='EDIT')
+
+    # Edit bones are not necessarily in the same order as bones
+    edit_bones = armature.data.edit_bones
+    edit_bone_indices = np.array([edit_bones.find(joint_name) for joint_name in joint_names])
+    edit_heads = np.empty((len(edit_bones), 3), dtype=np.float32)
+    edit_tails = np.empty((len(edit_bones), 3), dtype=np.float32)
+    edit_bones.foreach_get("head", edit_heads.ravel())
+    edit_bones.foreach_get("tail", edit_tails.ravel())
+
+    # Bones that did not move keep their exact positions
+    edit_heads[edit_bone_indices[moved]] = heads[moved]
+    edit_tails[edit_bone_indices[moved]] = tails[moved]
+    edit_bones.foreach_set("head", edit_heads.ravel())
+    edit_bones.foreach_set("tail", edit_tails.ravel())
+
+    bpy.ops.object.mode_set(mode='OBJECT')
+    bpy.context.view_layer.objects.active = previous_active
+
+    return True
+
+
 def get_uv_obj_path(uv_type, resolution):
     path = os.path.dirname(os.path.realpath(__file__))
     uv_obj_path = os.path.join(path, "data", "{}_{}.obj".format(uv_type, resolution))
@@ -33,12 +119,338 @@ def imported_object(func):
     return wrap
 
 
+def ensure_action(id_data):
+    if id_data.animation_data is None:
+        id_data.animation_data_create()
+
+    if id_data.animation_data.action is None:
+        id_data.animation_data.action = bpy.data.actions.new(name=id_data.name + "Action")
+
+    return id_data.animation_data.action
+
+
+# Keyframe.interpolation enum values for foreach_set()
+KEYFRAME_INTERPOLATION = {
+    'CONSTANT': 0,
+    'LINEAR': 1,
+    'BEZIER': 2,
+}
+
+
+def write_fcurve(action, data_path, index, frames, values, group=None, interpolation=None):
+    # Writes all keyframes of one F-curve at once instead of calling keyframe_insert() per frame.
+    # An existing F-curve for the same channel is replaced.
+    fcurve = action.fcurves.find(data_path, index=index)
+    if fcurve is not None:
+        action.fcurves.remove(fcurve)
+
+    if group is None:
+        fcurve = action.fcurves.new(data_path, index=index)
+    else:
+        fcurve = action.fcurves.new(data_path, index=index, action_group=group)
+
+    num_keyframes = len(frames)
+    co = np.empty(2 * num_keyframes, dtype=np.float32)
+    co[0::2] = frames
+    co[1::2] = values
+
+    fcurve.keyframe_points.add(num_keyframes)
+    fcurve.keyframe_points.foreach_set("co", co)
+    if interpolation is not None:
+        fcurve.keyframe_points.foreach_set("interpolation", [KEYFRAME_INTERPOLATION[interpolation]] * num_keyframes)
+    fcurve.update()
+
+    return fcurve
+
+
+def keyframe_pose_sequence(armature, joint_names, quaternions, pelvis_locations=None, frame_start=1,
+                           rotation_keep=None, location_keep=None, interpolation=None):
+    # quaternions: (num_frames, num_joints, 4) bone rotations in (w, x, y, z) order, one column per joint name
+    # pelvis_locations: (num_frames, 3) pose bone locations of the pelvis
+    # rotation_keep/location_keep: optional (num_frames, num_joints)/(num_frames,) masks of the frames to keyframe
+    action = ensure_action(armature)
+    frames = np.arange(frame_start, frame_start + quaternions.shape[0], dtype=np.float32)
+
+    for joint_index, bone_name in enumerate(joint_names):
+        pbone = armature.pose.bones[bone_name]
+        pbone.rotation_mode = 'QUATERNION'
+        data_path = pbone.path_from_id("rotation_quaternion")
+
+        keep = slice(None) if rotation_keep is None else rotation_keep[:, joint_index]
+        for channel in range(4):
+            write_fcurve(action, data_path, channel, frames[keep], quaternions[keep, joint_index, channel],
+                         group=bone_name, interpolation=interpolation)
+
+    if pelvis_locations is not None:
+        data_path = armature.pose.bones["pelvis"].path_from_id("location")
+
+        keep = slice(None) if location_keep is None else location_keep
+        for channel in range(3):
+            write_fcurve(action, data_path, channel, frames[keep], pelvis_locations[keep, channel],
+                         group="pelvis", interpolation=interpolation)
+
+    return action
+
+
+def sample_fcurve(fcurve, frames):
+    # Reads all keyframes with one foreach_get and samples them at the given frames.
+    # NumPy interpolation is only used where it is exact: on keyframes (e.g. imported animations with a
+    # keyframe on every frame) and between keyframes with LINEAR interpolation. All other frames, e.g. of
+    # hand-keyed BEZIER or CONSTANT curves, and curves with modifiers are evaluated by Blender.
+    frames = np.asarray(frames, dtype=np.float64)
+    num_keyframes = len(fcurve.keyframe_points)
+    if (num_keyframes == 0) or (len(fcurve.modifiers) > 0):
+        return np.array([fcurve.evaluate(frame) for frame in frames])
+
+    co = np.empty(2 * num_keyframes, dtype=np.float32)
+    fcurve.keyframe_points.foreach_get("co", co)
+    interpolation = np.empty(num_keyframes, dtype=np.int32)
+    fcurve.keyframe_points.foreach_get("interpolation", interpolation)
+    key_frames = co[0::2].astype(np.float64)
+
+    values = np.interp(frames, key_frames, co[1::2])
+
+    # Index of the keyframe at or before every frame, -1 before the first keyframe
+    segment = np.searchsorted(key_frames, frames, side='right') - 1
+    keyed = (segment >= 0) & (key_frames[np.maximum(segment, 0)] == frames)
+    inside = (segment >= 0) & (segment < num_keyframes - 1)
+    linear = inside & (interpolation[np.clip(segment, 0, num_keyframes - 1)] == KEYFRAME_INTERPOLATION['LINEAR'])
+    outside = (frames < key_frames[0]) | (frames > key_frames[-1])
+    exact = keyed | linear | (outside & (fcurve.extrapolation == 'CONSTANT'))
+
+    for index in np.flatnonzero(~exact):
+        values[index] = fcurve.evaluate(frames[index])
+
+    return values
+
+
+def sample_channels(action, pbone, property_name, frames):
+    # Returns the (num_frames, num_channels) values of a pose bone property sampled from the action.
+    # Channels without F-curve keep their current value for all frames.
+    current = getattr(pbone, property_name)
+    data_path = pbone.path_from_id(property_name)
+
+    values = np.empty((len(frames), len(current)))
+    for channel in range(len(current)):
+        fcurve = None if action is None else action.fcurves.find(data_path, index=channel)
+        if fcurve is None:
+            values[:, channel] = current[channel]
+        else:
+            values[:, channel] = sample_fcurve(fcurve, frames)
+
+    return values
+
+
+def pose_sequence_from_action(armature, joint_names, frames):
+    # Returns (num_frames, num_joints, 4) bone quaternions sampled from the armature action.
+    # Bones keep their rotation mode, euler and axis angle rotations are converted.
+    action = None
+    if armature.animation_data is not None:
+        action = armature.animation_data.action
+
+    quats = np.empty((len(frames), len(joint_names), 4))
+    for joint_index, joint_name in enumerate(joint_names):
+        pbone = armature.pose.bones[joint_name]
+        if pbone.rotation_mode == 'QUATERNION':
+            quats[:, joint_index] = sample_channels(action, pbone, "rotation_quaternion", frames)
+        elif pbone.rotation_mode == 'AXIS_ANGLE':
+            # (angle, x, y, z)
+            axis_angles = sample_channels(action, pbone, "rotation_axis_angle", frames)
+            axes = axis_angles[:, 1:] / np.maximum(np.linalg.norm(axis_angles[:, 1:], axis=1, keepdims=True), 1e-12)
+            quats[:, joint_index] = rodrigues_to_quat(axes * axis_angles[:, :1])
+        else:
+            eulers = sample_channels(action, pbone, "rotation_euler", frames)
+            quats[:, joint_index] = mat_to_quat(euler_to_mat(eulers, pbone.rotation_mode))
+
+    return quats
+
+
+def pose_locations_from_action(armature, bone_name, frames):
+    # Returns (num_frames, 3) pose bone locations sampled from the armature action
+    action = None
+    if armature.animation_data is not None:
+        action = armature.animation_data.action
+
+    return sample_channels(action, armature.pose.bones[bone_name], "location", frames)
+
+
+def keyframe_key_block_sequence(key, prefix, frames, values):
+    # Writes one F-curve per <prefix>### key block. values: (num_frames, num_key_blocks)
+    indices = key_block_indices(key, prefix)
+    action = ensure_action(key)
+
+    for column, index in enumerate(indices[:values.shape[1]]):
+        data_path = key.key_blocks[index].path_from_id("value")
+        write_fcurve(action, data_path, 0, frames, values[:, column])
+
+    return action
+
+
+def bake_pose_correctives(obj, armature, frames):
+    # Computes the corrective pose weights for all frames at once from the armature action
+    # and keyframes the Pose### shape keys of the mesh
+    SMPL_version = obj['SMPL_version']
+    joint_names = MODEL_JOINT_NAMES[SMPL_version].value
+    frames = np.asarray(frames, dtype=np.float64)
+
+    # Sign flipped quaternions of interpolated or reduced animations are handled by pose_corrective_weights()
+    quats = pose_sequence_from_action(armature, joint_names, frames)
+    weights = pose_corrective_weights(SMPL_version, quat_to_rodrigues(quats), len(joint_names))
+
+    keyframe_key_block_sequence(obj.data.shape_keys, "Pose", frames, weights)
+
+
+# Index of every numbered key block per shape key datablock, see key_block_indices()
+_key_block_index_cache = {}
+
+MAX_KEY_BLOCK_INDEX_CACHE_SIZE = 1000
+
+
+def key_block_indices(key, prefix):
+    # Returns the indices of the key blocks <prefix>000, <prefix>001, ... in key.key_blocks as array,
+    # so that values can be written with foreach_set instead of looking up every key block by name.
+    # The map is validated by the names of all key blocks, so it is rebuilt whenever key blocks are added,
+    # removed, renamed or reordered, and a Key that reuses the address of a freed one can not get stale indices.
+    key_blocks = key.key_blocks
+    names = key_blocks.keys()
+    cache_key = (key.as_pointer(), prefix)
+    cached = _key_block_index_cache.get(cache_key)
+    if (cached is not None) and (cached[0] == names):
+        return cached[1]
+
+    numbered = {}
+    for index, key_block in enumerate(key_blocks):
+        suffix = key_block.name[len(prefix):]
+        if key_block.name.startswith(prefix) and suffix.isdigit():
+            numbered[int(suffix)] = index
+
+    indices = np.empty(len(numbered), dtype=np.int64)
+    for number in range(len(numbered)):
+        if number not in numbered:
+            # Numbering has a gap, only the contiguous range from 000 is addressable
+            indices = indices[:number]
+            break
+        indices[number] = numbered[number]
+
+    # Entries of freed Keys are never looked up again, keep the cache from growing with every temporary copy
+    if len(_key_block_index_cache) >= MAX_KEY_BLOCK_INDEX_CACHE_SIZE:
+        _key_block_index_cache.clear()
+    _key_block_index_cache[cache_key] = (names, indices)
+    return indices
+
+
+def clear_key_block_index_cache():
+    _key_block_index_cache.clear()
+
+
+def set_key_block_values(key, prefix, values, start=0, expand_slider_range=False):
+    # Writes values to <prefix><start>, <prefix><start + 1>, ... with a single foreach_set call.
+    # foreach_set does not send a msgbus notification per key block, so callers update joint locations themselves.
+    # Values are clamped to the slider range like assigning key_block.value does. With expand_slider_range the
+    # slider min/max are widened to the values instead, so that the sliders show them.
+    # Returns the number of key blocks which were set.
+    key_blocks = key.key_blocks
+    indices = key_block_indices(key, prefix)[start:]
+    num_values = min(len(indices), len(values))
+    indices = indices[:num_values]
+    values = np.asarray(values, dtype=np.float32)[:num_values]
+
+    slider_min = np.empty(len(key_blocks), dtype=np.float32)
+    slider_max = np.empty(len(key_blocks), dtype=np.float32)
+    key_blocks.foreach_get("slider_min", slider_min)
+    key_blocks.foreach_get("slider_max", slider_max)
+
+    if expand_slider_range:
+        slider_min[indices] = np.minimum(slider_min[indices], values)
+        slider_max[indices] = np.maximum(slider_max[indices], values)
+        key_blocks.foreach_set("slider_min", slider_min)
+        key_blocks.foreach_set("slider_max", slider_max)
+    else:
+        values = np.clip(values, slider_min[indices], slider_max[indices])
+
+    all_values = np.empty(len(key_blocks), dtype=np.float32)
+    key_blocks.foreach_get("value", all_values)
+    all_values[indices] = values
+    key_blocks.foreach_set("value", all_values)
+
+    # foreach_set does not trigger any updates, so tag the mesh for re-evaluation ourselves
+    key.user.update_tag()
+
+    return num_values
+
+
+def num_key_blocks(key, prefix):
+    # Number of <prefix>000, <prefix>001, ... key blocks
+    return len(key_block_indices(key, prefix))
+
+
 def key_all_pose_correctives(obj, index):
     for key_block in obj.data.shape_keys.key_blocks:
         if key_block.name.startswith("Pose"):
             key_block.keyframe_insert("value", frame=index)
 
 
+def _buffer(out, shape):
+    # Returns out if it is a float32 buffer of the right shape, otherwise a new one.
+    # Callers that read the same mesh repeatedly can pass the previous result to avoid reallocation.
+    if (out is not None) and (out.shape == shape) and (out.dtype == np.float32):
+        return out
+    return np.empty(shape, dtype=np.float32)
+
+
+def vertex_coordinates(mesh, out=None):
+    # Returns the (num_vertices, 3) vertex coordinates of a mesh with a single foreach_get
+    coordinates = _buffer(out, (len(mesh.vertices), 3))
+    mesh.vertices.foreach_get("co", coordinates.ravel())
+    return coordinates
+
+
+def vertex_normals(mesh, out=None):
+    # Returns the (num_vertices, 3) vertex normals of a mesh
+    normals = _buffer(out, (len(mesh.vertices), 3))
+    mesh.vertices.foreach_get("normal", normals.ravel())
+    return normals
+
+
+def key_block_coordinates(key_block, out=None):
+    # Returns the (num_vertices, 3) coordinates stored in a shape key
+    coordinates = _buffer(out, (len(key_block.data), 3))
+    key_block.data.foreach_get("co", coordinates.ravel())
+    return coordinates
+
+
+def transform_points(points, matrix):
+    # Applies a 4x4 (mathutils or NumPy) matrix to (..., 3) points with one matrix multiply
+    matrix = np.asarray(matrix, dtype=np.float64)
+    return points @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def evaluated_vertex_coordinates(obj, depsgraph=None, world=False, normals=False):
+    # Returns the (num_vertices, 3) vertex coordinates of the evaluated object, i.e. with shape keys and
+    # armature applied, in object space or with world=True in world space.
+    # With normals=True returns (coordinates, normals), world space normals are rotated but not normalized.
+    if depsgraph is None:
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+
+    object_eval = obj.evaluated_get(depsgraph)
+    mesh_from_eval = object_eval.to_mesh()
+    try:
+        coordinates = vertex_coordinates(mesh_from_eval)
+        vertex_normal_values = vertex_normals(mesh_from_eval) if normals else None
+    finally:
+        object_eval.to_mesh_clear() # Remove temporary mesh
+
+    if world:
+        matrix_world = np.array(obj.matrix_world)
+        coordinates = transform_points(coordinates, matrix_world)
+        if normals:
+            vertex_normal_values = vertex_normal_values @ np.linalg.inv(matrix_world[:3, :3])
+
+    if normals:
+        return (coordinates, vertex_normal_values)
+    return coordinates
+
+
 @imported_object
 def import_obj(path, axis_forward='-Z', axis_up='Y'):
     bpy.ops.import_scene.obj(
@@ -68,15 +480,33 @@ def export_obj(path):
     )
 
 
-def export_fbx(path):
-    bpy.ops.export_scene.fbx(
-        filepath=path,
-        use_selection=True,
-        add_leaf_bones=False,
-        mesh_smooth_type='FACE',
-        use_mesh_modifiers=False,
-        use_active_collection=True,
-    )
+# Settings of the FBX exporter on top of the defaults of export_fbx(), per target application
+FBX_EXPORT_PROFILES = {
+    'DEFAULT': {},
+    'UNITY': {
+        "apply_scale_options": 'FBX_SCALE_ALL',
+        "bake_space_transform": True,
+    },
+    'UNREAL': {
+        "apply_scale_options": 'FBX_SCALE_NONE',
+        "use_tspace": True,
+        "use_armature_deform_only": True,
+    },
+}
+
+
+def export_fbx(path, profile='DEFAULT', **settings):
+    options = {
+        "filepath": path,
+        "use_selection": True,
+        "add_leaf_bones": False,
+        "mesh_smooth_type": 'FACE',
+        "use_mesh_modifiers": False,
+        "use_active_collection": True,
+    }
+    options.update(FBX_EXPORT_PROFILES[profile])
+    options.update(settings)
+    bpy.ops.export_scene.fbx(**options)
 
 
 def export_object(obj, export_type, path):
@@ -88,7 +518,396 @@ def export_object(obj, export_type, path):
         export_fbx(path=path)
     else:
         print ("ERROR, export type is not set to FBX or OBJ")
-    
+
+
+# Shape keys which are exported for each export_setting_shape_keys option
+EXPORT_SHAPE_KEY_PREFIXES = {
+    'SHAPE_POSE': ("Shape", "Exp", "Pose"),
+    'SHAPE': ("Shape",),
+    'NONE': (),
+}
+
+SMPL_SHAPE_KEY_PREFIXES = ("Shape", "Exp", "Pose")
+
+
+def animated_key_block_names(key):
+    action = key.animation_data.action if key.animation_data is not None else None
+    if action is None:
+        return set()
+
+    names = set()
+    for fcurve in action.fcurves:
+        match = re.fullmatch(r'key_blocks\["(.+)"\]\.value', fcurve.data_path)
+        if match is not None:
+            names.add(match.group(1))
+    return names
+
+
+def export_key_block_names(key, shape_keys='SHAPE_POSE', strip_unused=True):
+    # Returns the names of the key blocks to export. Key blocks which are not from the SMPL model are always
+    # kept. With strip_unused, key blocks which are zero or muted and not animated are dropped as well.
+    prefixes = EXPORT_SHAPE_KEY_PREFIXES[shape_keys]
+    animated = animated_key_block_names(key)
+
+    names = []
+    for key_block in key.key_blocks:
+        if key_block == key.reference_key:
+            continue
+
+        name = key_block.name
+        if name.startswith(SMPL_SHAPE_KEY_PREFIXES) and (not name.startswith(prefixes)):
+            continue
+        if strip_unused and (name not in animated) and (key_block.mute or (key_block.value == 0.0)):
+            continue
+        names.append(name)
+
+    return names
+
+
+def strip_key_blocks(obj, keep_names):
+    # Removes all key blocks of obj except the reference key and keep_names.
+    # The current values of removed body shape and expression key blocks are baked into the mesh, removed
+    # pose correctives are dropped since they depend on the pose. Returns the names of removed animated key blocks.
+    key = obj.data.shape_keys
+    keep_names = set(keep_names)
+    animated = animated_key_block_names(key)
+
+    basis = key_block_coordinates(key.reference_key)
+    delta = np.zeros_like(basis, dtype=np.float64)
+    coordinates = None
+
+    removed = [key_block for key_block in key.key_blocks if (key_block != key.reference_key) and (key_block.name not in keep_names)]
+    for key_block in removed:
+        if key_block.name.startswith("Pose") or key_block.mute or (key_block.value == 0.0) or (key_block.name in animated):
+            continue
+        coordinates = key_block_coordinates(key_block, out=coordinates)
+        delta += key_block.value * (coordinates - basis)
+
+    removed_animated = [key_block.name for key_block in removed if key_block.name in animated]
+
+    if len(removed) == len(key.key_blocks) - 1:
+        obj.shape_key_clear()
+        obj.data.vertices.foreach_set("co", (basis + delta).astype(np.float32).ravel())
+        obj.data.update()
+        return removed_animated
+
+    for key_block in removed:
+        obj.shape_key_remove(key_block)
+
+    # Key blocks store absolute coordinates, so the baked shape has to be added to every remaining one
+    if np.any(delta):
+        for key_block in key.key_blocks:
+            coordinates = key_block_coordinates(key_block, out=coordinates)
+            coordinates += delta
+            key_block.data.foreach_set("co", coordinates.ravel())
+        obj.data.vertices.foreach_set("co", key_block_coordinates(key.reference_key).ravel())
+        obj.data.update()
+
+    # The copied mesh shares the shape key action, it gets its own without the channels of removed key blocks
+    action = key.animation_data.action if key.animation_data is not None else None
+    if action is not None:
+        action = action.copy()
+        for fcurve in list(action.fcurves):
+            match = re.fullmatch(r'key_blocks\["(.+)"\]\.value', fcurve.data_path)
+            if (match is not None) and (match.group(1) not in keep_names):
+                action.fcurves.remove(fcurve)
+        key.animation_data.action = action
+
+    return removed_animated
+
+
+@contextmanager
+def export_mesh(obj, shape_keys='SHAPE_POSE', strip_unused=True):
+    # Temporary copy of an avatar mesh with only the shape keys to export. The copy takes over the name of
+    # obj while it exists, so the exported file contains the original object name.
+    name = obj.name
+    export_copy = obj.copy()
+    export_copy.data = obj.data.copy()
+    for collection in obj.users_collection:
+        collection.objects.link(export_copy)
+
+    original_action = None
+    action = None
+    try:
+        key = export_copy.data.shape_keys
+        if key is not None:
+            original_action = key.animation_data.action if key.animation_data is not None else None
+            removed_animated = strip_key_blocks(export_copy, export_key_block_names(key, shape_keys, strip_unused))
+            if removed_animated:
+                print(f"WARNING: Animation of {len(removed_animated)} shape keys is not exported: {', '.join(removed_animated[:5])}")
+
+            # Action copied by strip_key_blocks(), which is removed again with the export mesh
+            key = export_copy.data.shape_keys
+            if (key is not None) and (key.animation_data is not None) and (key.animation_data.action != original_action):
+                action = key.animation_data.action
+
+        obj.name = name + ".export"
+        export_copy.name = name
+        yield export_copy
+    finally:
+        mesh = export_copy.data
+        bpy.data.objects.remove(export_copy)
+        bpy.data.meshes.remove(mesh)
+        if (action is not None) and (action.users == 0):
+            bpy.data.actions.remove(action)
+        obj.name = name
+
+
+def export_avatar(obj, path, export_type=EXPORT_TYPE.FBX.value, shape_keys='SHAPE_POSE', strip_unused=True,
+                  profile='DEFAULT', bake_animation=True, bake_step=1.0, simplify=1.0, frames_per_file=0):
+    # Exports an avatar mesh and its armature with only the selected shape keys.
+    # With frames_per_file > 0, long animations are split into files <path>_000.fbx, <path>_001.fbx, ...
+    # with at most frames_per_file frames each, so that no single export has to bake the whole animation.
+    # Returns the list of written paths.
+    armature = obj.parent
+    scene = bpy.context.scene
+    (frame_start, frame_end, frame_current) = (scene.frame_start, scene.frame_end, scene.frame_current)
+    previous_active = get_active_object()
+
+    ranges = [(frame_start, frame_end)]
+    if (export_type == EXPORT_TYPE.FBX.value) and bake_animation and (frames_per_file > 0):
+        ranges = [(start, min(start + frames_per_file - 1, frame_end)) for start in range(frame_start, frame_end + 1, frames_per_file)]
+
+    (root, extension) = os.path.splitext(path)
+    paths = []
+    with export_mesh(obj, shape_keys, strip_unused) as mesh_obj:
+        deselect()
+        armature.select_set(True)
+        mesh_obj.select_set(True)
+        set_active_object(armature)
+
+        try:
+            for (index, (start, end)) in enumerate(ranges):
+                output_path = path if len(ranges) == 1 else f"{root}_{index:03d}{extension}"
+                if export_type == EXPORT_TYPE.OBJ.value:
+                    export_obj(path=output_path)
+                else:
+                    (scene.frame_start, scene.frame_end) = (start, end)
+                    export_fbx(
+                        output_path,
+                        profile=profile,
+                        use_active_collection=False,
+                        bake_anim=bake_animation,
+                        bake_anim_use_all_actions=False,
+                        bake_anim_use_nla_strips=False,
+                        bake_anim_step=bake_step,
+                        bake_anim_simplify_factor=simplify,
+                    )
+                paths.append(output_path)
+        finally:
+            (scene.frame_start, scene.frame_end) = (frame_start, frame_end)
+            scene.frame_set(frame_current)
+            set_active_object(previous_active)
+
+    return paths
+
+
+# Blender world (Z-up) to glTF (Y-up)
+Z_UP_TO_Y_UP = np.array([
+    [1.0, 0.0, 0.0, 0.0],
+    [0.0, 0.0, 1.0, 0.0],
+    [0.0, -1.0, 0.0, 0.0],
+    [0.0, 0.0, 0.0, 1.0],
+])
+
+# glTF skins support at most four joints per vertex in JOINTS_0/WEIGHTS_0
+MAX_JOINT_INFLUENCES = 4
+
+
+def triangle_vertex_buffers(mesh):
+    # glTF has per-vertex UVs while Blender has per-loop UVs, so vertices on UV seams are split.
+    # Returns (vertex_map, uvs, indices): the original vertex of every glTF vertex, its (num, 2) UVs
+    # (or None without UV map) and the (num_triangles * 3,) uint32 triangle indices.
+    mesh.calc_loop_triangles()
+    triangle_loops = np.empty(3 * len(mesh.loop_triangles), dtype=np.int32)
+    mesh.loop_triangles.foreach_get("loops", triangle_loops)
+
+    loop_vertices = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loop_vertices)
+
+    uv_layer = mesh.uv_layers.active
+    if uv_layer is None:
+        return (np.arange(len(mesh.vertices)), None, loop_vertices[triangle_loops].astype(np.uint32))
+
+    loop_uvs = np.empty((len(mesh.loops), 2), dtype=np.float32)
+    uv_layer.data.foreach_get("uv", loop_uvs.ravel())
+
+    loop_keys = np.empty(len(mesh.loops), dtype=[("vertex", np.int32), ("u", np.float32), ("v", np.float32)])
+    loop_keys["vertex"] = loop_vertices
+    loop_keys["u"] = loop_uvs[:, 0]
+    loop_keys["v"] = loop_uvs[:, 1]
+    (_, first_loops, loop_to_vertex) = np.unique(loop_keys, return_index=True, return_inverse=True)
+
+    # glTF UVs have their origin at the top left
+    uvs = loop_uvs[first_loops]
+    uvs[:, 1] = 1.0 - uvs[:, 1]
+
+    return (loop_vertices[first_loops], uvs, loop_to_vertex.ravel()[triangle_loops].astype(np.uint32))
+
+
+def skin_influences(weights):
+    # (num_vertices, num_joints) weights -> the (num_vertices, 4) indices and normalized weights of the
+    # strongest joints of every vertex
+    num_influences = min(MAX_JOINT_INFLUENCES, weights.shape[1])
+    joints = np.argsort(weights, axis=1)[:, ::-1][:, :num_influences]
+    joint_weights = np.take_along_axis(weights, joints, axis=1)
+
+    influences = np.zeros((len(weights), MAX_JOINT_INFLUENCES), dtype=np.float32)
+    influences[:, :num_influences] = joint_weights
+    totals = influences.sum(axis=1, keepdims=True)
+    influences = np.divide(influences, totals, out=np.zeros_like(influences), where=totals > 0.0)
+    influences[totals[:, 0] == 0.0, 0] = 1.0
+
+    indices = np.zeros((len(weights), MAX_JOINT_INFLUENCES), dtype=np.uint8 if weights.shape[1] < 256 else np.uint16)
+    indices[:, :num_influences] = joints
+    return (indices, influences)
+
+
+def sorted_bones(armature):
+    # Bones with every parent before its children, as required for the joint nodes
+    bones = []
+    stack = [bone for bone in reversed(armature.data.bones) if bone.parent is None]
+    while stack:
+        bone = stack.pop()
+        bones.append(bone)
+        stack.extend(reversed(bone.children))
+    return bones
+
+
+def skin_weights(obj, bone_names, model=None):
+    # Returns the (num_vertices, len(bone_names)) skinning weights of an avatar mesh. Vertex groups can only be
+    # read vertex by vertex, so the weights of the packed body model are used if one is given, see
+    # templates.get_body_model(). Bones which are not model joints (e.g. root) get zero weights.
+    if (model is None) or (model.num_vertices != len(obj.data.vertices)):
+        return vertex_group_weights(obj, bone_names)
+
+    column_of_joint = {name: column for (column, name) in enumerate(MODEL_JOINT_NAMES[model.SMPL_version].value)}
+    weights = np.zeros((model.num_vertices, len(bone_names)), dtype=np.float32)
+    for (column, bone_name) in enumerate(bone_names):
+        if bone_name in column_of_joint:
+            weights[:, column] = model.weights[:, column_of_joint[bone_name]]
+    return weights
+
+
+def export_glb(obj, path, shape_keys='SHAPE_POSE', strip_unused=True, animation=True, model=None):
+    # Writes an avatar mesh, its skin, the selected shape keys as morph targets and the animation of the scene
+    # frame range to a .glb file. All data is read with foreach_get and sampled from the F-curves, no frame
+    # is set and no mesh is evaluated. model: the packed body model of the avatar for its skinning weights.
+    armature = obj.parent
+    scene = bpy.context.scene
+    builder = GLTFBuilder()
+
+    bones = sorted_bones(armature)
+    bone_names = [bone.name for bone in bones]
+    bone_index = {name: index for (index, name) in enumerate(bone_names)}
+
+    # Rest transforms of the bones in armature space and relative to their parent
+    rest_matrices = np.array([np.array(bone.matrix_local) for bone in bones])
+    local_rest = rest_matrices.copy()
+    for (index, bone) in enumerate(bones):
+        if bone.parent is not None:
+            local_rest[index] = np.linalg.inv(rest_matrices[bone_index[bone.parent.name]]) @ rest_matrices[index]
+    rest_rotations = local_rest[:, :3, :3]
+    rest_translations = local_rest[:, :3, 3]
+
+    # Armature node carries the world transform, the joints and the mesh are in armature space
+    armature_node = builder.add_node(
+        root=True,
+        name=armature.name,
+        matrix=(Z_UP_TO_Y_UP @ np.array(armature.matrix_world)).T.ravel().tolist(),
+    )
+    joint_nodes = []
+    for (index, bone) in enumerate(bones):
+        joint_nodes.append(builder.add_node(
+            name=bone.name,
+            translation=rest_translations[index].tolist(),
+            rotation=mat_to_quat(rest_rotations[index])[[1, 2, 3, 0]].tolist(),
+        ))
+    for (index, bone) in enumerate(bones):
+        children = [joint_nodes[bone_index[child.name]] for child in bone.children]
+        if children:
+            builder.gltf["nodes"][joint_nodes[index]]["children"] = children
+    builder.gltf["nodes"][armature_node]["children"] = [joint_nodes[index] for (index, bone) in enumerate(bones) if bone.parent is None]
+
+    skin = builder.add_skin(joint_nodes, np.linalg.inv(rest_matrices).astype(np.float32), skeleton=armature_node)
+
+    with export_mesh(obj, shape_keys, strip_unused) as mesh_obj:
+        mesh = mesh_obj.data
+        key = mesh.shape_keys
+
+        # Mesh to armature space, see pack_body_model()
+        matrix = np.array(mesh_obj.matrix_parent_inverse @ mesh_obj.matrix_basis)
+        linear = matrix[:3, :3]
+
+        (vertex_map, uvs, indices) = triangle_vertex_buffers(mesh)
+        coordinates = vertex_coordinates(mesh) if key is None else key_block_coordinates(key.reference_key)
+        positions = transform_points(coordinates, matrix)[vertex_map].astype(np.float32)
+
+        normals = vertex_normals(mesh) @ np.linalg.inv(linear)
+        normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+        normals = normals[vertex_map].astype(np.float32)
+
+        (joints, weights) = skin_influences(skin_weights(mesh_obj, bone_names, model)[vertex_map])
+
+        morph_names = []
+        morph_targets = []
+        morph_weights = []
+        if key is not None:
+            target_coordinates = None
+            for key_block in key.key_blocks:
+                if key_block == key.reference_key:
+                    continue
+                target_coordinates = key_block_coordinates(key_block, out=target_coordinates)
+                morph_targets.append(((target_coordinates - coordinates) @ linear.T)[vertex_map].astype(np.float32))
+                morph_names.append(key_block.name)
+                morph_weights.append(0.0 if key_block.mute else key_block.value)
+
+        mesh_index = builder.add_mesh(
+            positions,
+            indices,
+            normals=normals,
+            uvs=uvs,
+            joints=joints,
+            weights=weights,
+            morph_targets=morph_targets,
+            morph_names=morph_names,
+            morph_weights=morph_weights,
+            name=mesh.name,
+        )
+        mesh_node = builder.add_node(root=True, name=mesh_obj.name, mesh=mesh_index, skin=skin)
+
+        if animation:
+            frames = np.arange(scene.frame_start, scene.frame_end + 1, dtype=np.float64)
+            times = (frames - scene.frame_start) * scene.render.fps_base / scene.render.fps
+
+            # Joint node transforms: rest transform relative to the parent followed by the pose bone transform
+            quats = pose_sequence_from_action(armature, bone_names, frames)
+            rotations = mat_to_quat(rest_rotations[None] @ quat_to_mat(quats))
+            rotations = quat_continuous(rotations, axis=0)[..., [1, 2, 3, 0]]
+
+            channels = []
+            for (index, bone_name) in enumerate(bone_names):
+                locations = pose_locations_from_action(armature, bone_name, frames)
+                translations = rest_translations[index] + locations @ rest_rotations[index].T
+                channels.append((joint_nodes[index], "translation", translations.astype(np.float32)))
+                channels.append((joint_nodes[index], "rotation", rotations[:, index].astype(np.float32)))
+
+            animated = animated_key_block_names(key) if key is not None else set()
+            if animated:
+                action = key.animation_data.action
+                values = np.tile(np.asarray(morph_weights, dtype=np.float32), (len(frames), 1))
+                for (column, name) in enumerate(morph_names):
+                    if name in animated:
+                        fcurve = action.fcurves.find(f'key_blocks["{name}"].value')
+                        values[:, column] = sample_fcurve(fcurve, frames)
+                channels.append((mesh_node, "weights", values))
+
+            action = armature.animation_data.action if armature.animation_data is not None else None
+            builder.add_animation(times, channels, name=action.name if action is not None else None)
+
+    builder.write_glb(path)
+    return path
+
 
 def set_active_object(obj):
     bpy.context.view_layer.objects.active = obj
@@ -152,11 +971,20 @@ def rodrigues_from_pose(armature, bone_name):
     armature.pose.bones[bone_name].rotation_mode = 'QUATERNION'
 
     quat = armature.pose.bones[bone_name].rotation_quaternion
-    (axis, angle) = quat.to_axis_angle()
-    rodrigues = axis
-    rodrigues.normalize()
-    rodrigues = rodrigues * angle
-    return rodrigues
+    return quat_to_rodrigues(quat[:])
+
+
+def pose_from_armature(armature, joint_names):
+    # Returns the armature pose in rodrigues representation as (num_joints, 3) array
+    quats = np.empty((len(joint_names), 4))
+    for index, joint_name in enumerate(joint_names):
+        pbone = armature.pose.bones[joint_name]
+
+        # Use quaternion mode for all bone rotations
+        pbone.rotation_mode = 'QUATERNION'
+        quats[index] = pbone.rotation_quaternion
+
+    return quat_to_rodrigues(quats)
 
 
 def correct_for_anim_format(anim_format, armature):
@@ -171,29 +999,20 @@ def correct_for_anim_format(anim_format, armature):
 
 
 def set_pose_from_rodrigues(armature, bone_name, rodrigues, rodrigues_reference=None, frame=1):  # I wish frame=bpy.data.scenes[0].frame_current worked here, but it doesn't
-    rod = Vector((rodrigues[0], rodrigues[1], rodrigues[2]))
-    angle_rad = rod.length
-    axis = rod.normalized()
-
     pbone = armature.pose.bones[bone_name]
     pbone.rotation_mode = 'QUATERNION'
-    quat = Quaternion(axis, angle_rad)
 
-    if rodrigues_reference is None:
-        pbone.rotation_quaternion = quat
-    else:
+    rod = np.asarray(rodrigues[:3], dtype=np.float64)
+    if rodrigues_reference is not None:
         # SMPL-X is adding the reference rodrigues rotation to the
         # relaxed hand rodrigues rotation, so we have to do the same here.
         # This means that pose values for relaxed hand model cannot be
         # interpreted as rotations in the local joint coordinate system of the relaxed hand.
         # https://github.com/vchoutas/smplx/blob/f4206853a4746139f61bdcf58571f2cea0cbebad/smplx/body_models.py#L1190
         #   full_pose += self.pose_mean
-        rod_reference = Vector((rodrigues_reference[0], rodrigues_reference[1], rodrigues_reference[2]))
-        rod_result = rod + rod_reference
-        angle_rad_result = rod_result.length
-        axis_result = rod_result.normalized()
-        quat_result = Quaternion(axis_result, angle_rad_result)
-        pbone.rotation_quaternion = quat_result
+        rod = rod + np.asarray(rodrigues_reference[:3], dtype=np.float64)
+
+    pbone.rotation_quaternion = Quaternion(rodrigues_to_quat(rod))
 
     pbone.keyframe_insert(data_path="rotation_quaternion", frame=frame)
 
@@ -210,3 +1029,117 @@ def transfer_uv(mesh_from, mesh_to):
     select_object(mesh_from)
     set_active_object(mesh_from)
     bpy.ops.object.join_uvs()
+
+
+def vertex_group_weights(obj, group_names):
+    # Returns the (num_vertices, len(group_names)) weights of the named vertex groups, zero where unassigned.
+    # There is no bulk access to vertex groups, so this loops over all vertices. Use skin_weights() with the
+    # packed body model instead, which only reads the vertex groups once per model when packing it.
+    column_of_group = {group.index: group_names.index(group.name) for group in obj.vertex_groups if group.name in group_names}
+    weights = np.zeros((len(obj.data.vertices), len(group_names)), dtype=np.float32)
+    for vertex in obj.data.vertices:
+        for group in vertex.groups:
+            column = column_of_group.get(group.group)
+            if column is not None:
+                weights[vertex.index, column] = group.weight
+    return weights
+
+
+def pack_body_model(obj, SMPL_version, gender, include_pose_correctives=True):
+    # Reads the template vertices, shape directions, skinning weights and pose corrective directions of an
+    # unmodified avatar mesh into a bpy independent BodyModel, see body_model.py.
+    # The arrays are converted from mesh coordinates to the SMPL frame (armature space / 100).
+    mesh = obj.data
+    armature = obj.parent
+    joint_names = MODEL_JOINT_NAMES[SMPL_version].value
+    num_vertices = len(mesh.vertices)
+
+    # Mesh to armature space, without depending on an evaluated depsgraph
+    matrix = np.array(obj.matrix_parent_inverse @ obj.matrix_basis) / 100.0
+    linear = matrix[:3, :3]
+
+    key = mesh.shape_keys
+    basis = key_block_coordinates(key.reference_key).astype(np.float64)
+    v_template = transform_points(basis, matrix)
+
+    def read_directions(prefix):
+        indices = key_block_indices(key, prefix)
+        directions = np.empty((num_vertices, 3, len(indices)), dtype=np.float32)
+        coordinates = None
+        for (column, index) in enumerate(indices):
+            coordinates = key_block_coordinates(key.key_blocks[int(index)], out=coordinates)
+            directions[:, :, column] = (coordinates - basis) @ linear.T
+        return directions
+
+    shapedirs = read_directions("Shape")
+    posedirs = read_directions("Pose") if include_pose_correctives else None
+
+    # Skinning weights from the vertex groups of the joints
+    weights = vertex_group_weights(obj, joint_names)
+
+    # Rest joints and kinematic tree from the armature
+    bones = armature.data.bones
+    rest_joints = np.array([bones[joint_name].head_local for joint_name in joint_names]) / 100.0
+
+    # The pelvis is parented to the root bone, which is not a model joint. Bones outside the model are regarded as no parent.
+    index_of = {name: index for (index, name) in enumerate(joint_names)}
+    parents = np.array(
+        [-1 if bones[joint_name].parent is None else index_of.get(bones[joint_name].parent.name, -1) for joint_name in joint_names],
+        dtype=np.int64,
+    )
+
+    return BodyModel(SMPL_version, gender, v_template, shapedirs, weights, rest_joints, parents=parents, posedirs=posedirs)
+
+
+def betas_from_mesh(mesh):
+    # Returns the betas of an avatar mesh: the Shape### key values, with muted keys regarded as zero.
+    # Shared crowd meshes have no shape keys, they store the betas they were baked with.
+    key = mesh.shape_keys
+    if key is None:
+        return np.asarray(mesh.get("betas", []), dtype=np.float64)
+
+    indices = key_block_indices(key, "Shape")
+    values = np.empty(len(key.key_blocks), dtype=np.float32)
+    mutes = np.empty(len(key.key_blocks), dtype=bool)
+    key.key_blocks.foreach_get("value", values)
+    key.key_blocks.foreach_get("mute", mutes)
+    return np.where(mutes[indices], 0.0, values[indices]).astype(np.float64)
+
+
+def sole_heights(obj, armature, model, frames, chunk_size=1000):
+    # Returns the world z of the lowest sole vertex of the avatar at every frame of its action.
+    # The candidate vertices are posed with the NumPy body model (see body_model.py) from the F-curves,
+    # so no frame has to be set and no mesh has to be evaluated.
+    frames = np.asarray(frames, dtype=np.float64)
+    SMPL_version = obj['SMPL_version']
+    joint_names = MODEL_JOINT_NAMES[SMPL_version].value
+
+    betas = betas_from_mesh(obj.data)
+    vertex_indices = model.sole_vertex_indices()
+    pose_correctives = obj.data.shape_keys is not None
+
+    # The root bone above the pelvis (rotated for AMASS, see correct_for_anim_format()) moves the whole body:
+    # armature space = root_rest @ root_basis @ root_rest^-1 @ (SMPL frame * 100)
+    root_rest = np.array(armature.data.bones["root"].matrix_local)
+    root_quats = pose_sequence_from_action(armature, ["root"], frames)[:, 0]
+    root_locations = pose_locations_from_action(armature, "root", frames)
+    root_basis = np.zeros((len(frames), 4, 4))
+    root_basis[:, :3, :3] = quat_to_mat(root_quats)
+    root_basis[:, :3, 3] = root_locations
+    root_basis[:, 3, 3] = 1.0
+    to_world = np.array(armature.matrix_world) @ root_rest @ root_basis @ np.linalg.inv(root_rest)
+
+    heights = np.empty(len(frames))
+    for start in range(0, len(frames), chunk_size):
+        chunk_frames = frames[start:start + chunk_size]
+        poses = quat_to_rodrigues(pose_sequence_from_action(armature, joint_names, chunk_frames))
+        trans = pose_locations_from_action(armature, "pelvis", chunk_frames) / 100.0
+
+        (vertices, _) = model.forward(betas, poses, trans, vertex_indices=vertex_indices, pose_correctives=pose_correctives)
+
+        # Only the z row of the world transform is needed
+        chunk_to_world = to_world[start:start + chunk_size, 2]
+        z = np.einsum('fi,fvi->fv', chunk_to_world[:, :3], 100.0 * vertices) + chunk_to_world[:, 3:]
+        heights[start:start + chunk_size] = z.min(axis=1)
+
+    return heights
@@ -0,0 +1,245 @@
+# SMPL family body model in pure NumPy: shape blending, joint regression, forward kinematics and linear
+# blend skinning, batched over any number of frames.
+#
+# The mesh arrays (template vertices, shape directions, skinning weights and optionally the pose corrective
+# directions) live in the model .blend files. They are packed once per model into
+# data/<version>_model_<gender>.npz from inside Blender, see blender.pack_body_model(). After that, posing
+# does not need bpy at all, so ground contact, bounding boxes and validation run at NumPy speed.
+#
+# Everything is in the SMPL frame (Y-up, meters), the frame of the joint regressors and the .npz motion files.
+# A Blender avatar uses the same frame scaled by 100 in armature space.
+import os
+
+import numpy as np
+
+from .correctives import (
+    pose_corrective_weights,
+)
+from .globals import (
+    MODEL_JOINT_NAMES,
+    PATH,
+)
+from .regressors import (
+    BETAS_TO_JOINTS_SUFFIXES,
+    load_betas_to_joints,
+)
+from .rotations import (
+    rodrigues_to_mat,
+)
+
+# Parents of the 22 body joints, shared by all SMPL family models
+BODY_PARENTS = [-1, 0, 0, 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 9, 9, 12, 13, 14, 16, 17, 18, 19]
+
+# Process-wide cache of loaded models, keyed by (SMPL_version, gender)
+_body_model_cache = {}
+
+
+def kinematic_parents(SMPL_version):
+    # Returns the parent joint index of every joint (-1 for the pelvis), derived from the joint names:
+    # face joints hang off the head, finger joints off the wrist and toe joints off the foot, each
+    # followed by a chain of the numbered joints of the same finger or toe.
+    joint_names = MODEL_JOINT_NAMES[SMPL_version].value
+    index_of = {name: index for (index, name) in enumerate(joint_names)}
+    parents = list(BODY_PARENTS)
+
+    for name in joint_names[len(BODY_PARENTS):]:
+        if name in ('jaw', 'left_eye', 'right_eye'):
+            parents.append(index_of['head'])
+            continue
+
+        side = name.split("_")[0]
+        number = int(name[-1])
+        if number > 1:
+            parents.append(index_of[name[:-1] + str(number - 1)])
+        elif "toe" in name:
+            parents.append(index_of[side + "_foot"])
+        else:
+            parents.append(index_of[side + "_wrist"])
+
+    return np.array(parents, dtype=np.int64)
+
+
+def forward_kinematics(rotations, joints, parents):
+    # rotations: (..., num_joints, 3, 3) local joint rotations, joints: (..., num_joints, 3) rest joint locations.
+    # Returns the (..., num_joints, 4, 4) global joint transforms. Parents have to come before their children.
+    batch_shape = np.broadcast_shapes(rotations.shape[:-3], joints.shape[:-2])
+    num_joints = len(parents)
+
+    local_transforms = np.zeros(batch_shape + (num_joints, 4, 4))
+    local_transforms[..., :3, :3] = rotations
+    local_transforms[..., 3, 3] = 1.0
+
+    # Offsets to the parent joint, the pelvis keeps its absolute rest location
+    offsets = np.array(np.broadcast_to(joints, batch_shape + joints.shape[-2:]))
+    offsets[..., 1:, :] -= offsets[..., parents[1:], :]
+    local_transforms[..., :3, 3] = offsets
+
+    transforms = np.empty_like(local_transforms)
+    transforms[..., 0, :, :] = local_transforms[..., 0, :, :]
+    for index in range(1, num_joints):
+        transforms[..., index, :, :] = transforms[..., parents[index], :, :] @ local_transforms[..., index, :, :]
+
+    return transforms
+
+
+class BodyModel:
+    def __init__(self, SMPL_version, gender, v_template, shapedirs, weights, rest_joints, parents=None, posedirs=None):
+        # v_template: (num_vertices, 3), shapedirs: (num_vertices, 3, num_betas), weights: (num_vertices, num_joints),
+        # rest_joints: (num_joints, 3) joint locations of the template, posedirs: (num_vertices, 3, num_pose_correctives)
+        self.SMPL_version = SMPL_version
+        self.gender = gender
+        self.v_template = np.asarray(v_template, dtype=np.float64)
+        self.shapedirs = np.asarray(shapedirs)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.rest_joints = np.asarray(rest_joints, dtype=np.float64)
+        self.parents = kinematic_parents(SMPL_version) if parents is None else np.asarray(parents, dtype=np.int64)
+        self.posedirs = None if posedirs is None else np.asarray(posedirs)
+
+    @property
+    def num_vertices(self):
+        return self.v_template.shape[0]
+
+    @property
+    def num_joints(self):
+        return len(self.parents)
+
+    @property
+    def num_betas(self):
+        return self.shapedirs.shape[-1]
+
+    def sole_vertex_indices(self, height=0.03):
+        # Candidate vertices for ground contact: vertices of the feet which are at most height [m] above the
+        # lowest foot vertex of the template. Much fewer than all vertices, but they contain the lowest
+        # point of the body whenever it stands on its feet, also on tiptoes.
+        joint_names = MODEL_JOINT_NAMES[self.SMPL_version].value
+        foot_joints = [index for (index, name) in enumerate(joint_names) if ("ankle" in name) or ("foot" in name) or ("toe" in name)]
+
+        foot_vertices = np.flatnonzero(np.isin(np.argmax(self.weights, axis=1), foot_joints))
+        up = self.v_template[foot_vertices, 1]
+        return foot_vertices[up <= up.min() + height]
+
+    def _betas(self, betas):
+        # Pads or truncates (..., n) betas to the number of shape components of the model
+        betas = np.asarray(betas, dtype=np.float64)
+        padded = np.zeros(betas.shape[:-1] + (self.num_betas,))
+        num_betas = min(betas.shape[-1], self.num_betas)
+        padded[..., :num_betas] = betas[..., :num_betas]
+        return padded
+
+    def shape(self, betas, vertex_indices=None):
+        # Returns the (..., num_vertices, 3) vertices of the body shape in rest pose
+        betas = self._betas(betas)
+        if vertex_indices is None:
+            return self.v_template + np.tensordot(betas, self.shapedirs, axes=([-1], [-1]))
+
+        return self.v_template[vertex_indices] + np.tensordot(betas, self.shapedirs[vertex_indices], axes=([-1], [-1]))
+
+    def joint_locations(self, betas):
+        # Returns the (..., num_joints, 3) rest joint locations of the body shape.
+        # SMPLH has no betas-to-joints regressor, its joints stay at the template locations.
+        betas = self._betas(betas)
+        if (self.SMPL_version == 'SMPLH') or (self.num_betas not in BETAS_TO_JOINTS_SUFFIXES):
+            return np.broadcast_to(self.rest_joints, betas.shape[:-1] + self.rest_joints.shape)
+
+        (betas_to_joints, template_j) = load_betas_to_joints(self.SMPL_version, self.gender, self.num_betas)
+        return np.tensordot(betas, betas_to_joints, axes=([-1], [-1])) + template_j
+
+    def _rotations(self, poses):
+        # (..., num_pose_joints * 3) or (..., num_pose_joints, 3) rodrigues vectors -> (..., num_joints, 3, 3).
+        # Joints missing in the pose (e.g. hands of a body only pose) keep their rest orientation.
+        poses = np.asarray(poses, dtype=np.float64)
+        poses = poses.reshape(poses.shape[:-1] + (-1, 3)) if poses.shape[-1] != 3 else poses
+        padded = np.zeros(poses.shape[:-2] + (self.num_joints, 3))
+        num_joints = min(poses.shape[-2], self.num_joints)
+        padded[..., :num_joints, :] = poses[..., :num_joints, :]
+        return (padded, rodrigues_to_mat(padded))
+
+    def joint_transforms(self, betas, poses, trans=None):
+        # Returns the (..., num_joints, 4, 4) global joint transforms of the posed body
+        (_, rotations) = self._rotations(poses)
+        transforms = forward_kinematics(rotations, self.joint_locations(betas), self.parents)
+        if trans is not None:
+            transforms[..., :3, 3] += np.asarray(trans, dtype=np.float64)[..., None, :]
+        return transforms
+
+    def forward(self, betas, poses, trans=None, vertex_indices=None, pose_correctives=True):
+        # Poses the body with linear blend skinning.
+        # betas: (..., num_betas), poses: (..., num_joints * 3) rodrigues vectors, trans: (..., 3).
+        # The leading dimensions are broadcast, so one betas vector can be used for a whole sequence of poses.
+        # With vertex_indices only these vertices are computed, which is much faster for e.g. ground contact.
+        # Returns (vertices (..., num_vertices, 3), joints (..., num_joints, 3)).
+        (rodrigues, rotations) = self._rotations(poses)
+        rest_joints = self.joint_locations(betas)
+        transforms = forward_kinematics(rotations, rest_joints, self.parents)
+
+        vertices = self.shape(betas, vertex_indices)
+        if pose_correctives and (self.posedirs is not None):
+            weights = pose_corrective_weights(self.SMPL_version, rodrigues, self.num_joints)
+            posedirs = self.posedirs if vertex_indices is None else self.posedirs[vertex_indices]
+            num_correctives = min(weights.shape[-1], posedirs.shape[-1])
+            vertices = vertices + np.tensordot(weights[..., :num_correctives], posedirs[..., :num_correctives], axes=([-1], [-1]))
+
+        # Skinning transforms move the rest pose joints to their posed locations
+        skinning = transforms[..., :3, :].copy()
+        skinning[..., :3, 3] -= np.einsum('...ij,...j->...i', transforms[..., :3, :3], rest_joints)
+
+        weights = self.weights if vertex_indices is None else self.weights[vertex_indices]
+        vertex_transforms = np.einsum('vj,...jab->...vab', weights, skinning)
+        vertices = np.einsum('...vij,...vj->...vi', vertex_transforms[..., :3], vertices) + vertex_transforms[..., 3]
+
+        joints = transforms[..., :3, 3]
+        if trans is not None:
+            trans = np.asarray(trans, dtype=np.float64)[..., None, :]
+            vertices = vertices + trans
+            joints = joints + trans
+
+        return (vertices, joints)
+
+
+def body_model_path(SMPL_version, gender):
+    return os.path.join(PATH, "data", f"{SMPL_version.lower()}_model_{gender}.npz")
+
+
+def save_body_model(path, model):
+    np.savez(
+        path,
+        v_template=model.v_template.astype(np.float32),
+        shapedirs=model.shapedirs.astype(np.float32),
+        weights=model.weights.astype(np.float32),
+        rest_joints=model.rest_joints,
+        parents=model.parents,
+        **({} if model.posedirs is None else {"posedirs": model.posedirs.astype(np.float32)}),
+    )
+
+
+def load_body_model(SMPL_version, gender, path=None):
+    # Returns the packed body model, or None if it has not been packed yet
+    key = (SMPL_version, gender)
+    if key not in _body_model_cache:
+        path = path or body_model_path(SMPL_version, gender)
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as data:
+            _body_model_cache[key] = BodyModel(
+                SMPL_version,
+                gender,
+                data["v_template"],
+                data["shapedirs"],
+                data["weights"],
+                data["rest_joints"],
+                parents=data["parents"],
+                posedirs=data["posedirs"] if "posedirs" in data else None,
+            )
+
+    return _body_model_cache[key]
+
+
+def cache_body_model(model):
+    # Keeps a model that was packed in this session, so it does not have to be read back from disk
+    _body_model_cache[(model.SMPL_version, model.gender)] = model
+    return model
+
+
+def clear_body_model_cache():
+    _body_model_cache.clear()
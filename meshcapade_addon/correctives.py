@@ -0,0 +1,42 @@
+# Pose corrective blendshape weights for SMPL family models.
+#
+# Pure NumPy, batched over any number of leading dimensions so that a single pose (num_joints, 3)
+# and a whole sequence (num_frames, num_joints, 3) go through the same code path.
+# Based on https://github.com/gulvarol/surreal/blob/master/datageneration/main_part1.py
+import numpy as np
+
+from .rotations import (
+    rodrigues_to_mat,
+    rodrigues_to_quat,
+)
+
+# TODO for the time being, the SMPLX pose correctives only go to 0-206.
+# It should be 0-485, but we're not sure why the fingers aren't being written out of the blender-worker
+NUM_SMPLX_POSE_CORRECTIVES = 207
+
+
+def pose_corrective_weights(SMPL_version, poses, num_joints):
+    # poses: (..., num_joints * 3) or (..., num_joints, 3) rodrigues vectors of all joints including pelvis
+    # Returns (..., num_pose_correctives) weights, in the order of the Pose### shape keys
+    poses = np.asarray(poses, dtype=np.float64)
+    poses = poses.reshape(poses.shape[:-1] + (-1, 3)) if poses.shape[-1] != 3 else poses
+    poses = poses[..., :num_joints, :]
+    batch_shape = poses.shape[:-2]
+
+    if SMPL_version in ('SMPLX', 'SMPLH'):
+        # Features are the (R - I) entries of all joints except the pelvis. Only the joints which have
+        # pose corrective shape keys are converted.
+        num_corrective_joints = NUM_SMPLX_POSE_CORRECTIVES // 9
+        mats = rodrigues_to_mat(poses[..., 1:1 + num_corrective_joints, :])
+        return (mats - np.eye(3)).reshape(batch_shape + (-1,))
+
+    elif SMPL_version == 'SUPR':
+        # Features are the quaternions of all joints including the pelvis as (x, y, z, w - 1).
+        # Both signs of a quaternion are the same rotation, the features use the w >= 0 form, so that
+        # rotations by more than pi (e.g. from sign flipped keyframes) give the same weights.
+        quats = rodrigues_to_quat(poses)
+        quats = np.where(quats[..., :1] < 0.0, -quats, quats)
+        features = np.concatenate((quats[..., 1:], quats[..., :1] - 1.0), axis=-1)
+        return features.reshape(batch_shape + (-1,))
+
+    raise ValueError(f"No pose correctives for SMPL version: {SMPL_version}")
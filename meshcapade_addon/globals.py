@@ -212,6 +212,9 @@ NUM_SMPLH_JOINTS = len(SMPLX_JOINT_NAMES)
 NUM_SMPLH_BODY_JOINTS = 21   
 NUM_SMPLH_HAND_JOINTS = 15   # must be per hand
 
+# The first shape components (Shape000-Shape009) control the body, the remaining ones the face
+NUM_BODY_SHAPES = 10
+
 OS = platform.system()
 PATH = os.path.dirname(os.path.realpath(__file__))
 
@@ -0,0 +1,209 @@
+# Minimal glTF 2.0 binary (.glb) writer for NumPy arrays.
+#
+# Pure NumPy, no bpy, see blender.export_glb() for the avatar export. Accessors reference the arrays they
+# were created from, nothing is concatenated in memory: write_glb() streams every array directly into the
+# binary chunk of the file. Arrays which are already contiguous and of a glTF component type (e.g. the
+# float32 arrays filled by foreach_get) are written without any copy.
+import json
+import struct
+
+import numpy as np
+
+GLB_MAGIC = 0x46546C67  # "glTF"
+GLB_VERSION = 2
+CHUNK_JSON = 0x4E4F534A  # "JSON"
+CHUNK_BIN = 0x004E4942  # "BIN\0"
+
+COMPONENT_TYPES = {
+    np.dtype(np.int8): 5120,
+    np.dtype(np.uint8): 5121,
+    np.dtype(np.int16): 5122,
+    np.dtype(np.uint16): 5123,
+    np.dtype(np.uint32): 5125,
+    np.dtype(np.float32): 5126,
+}
+
+ACCESSOR_TYPES = {
+    1: "SCALAR",
+    2: "VEC2",
+    3: "VEC3",
+    4: "VEC4",
+    16: "MAT4",
+}
+
+TARGET_ARRAY_BUFFER = 34962
+TARGET_ELEMENT_ARRAY_BUFFER = 34963
+
+
+def _padding(length, alignment=4):
+    return (-length) % alignment
+
+
+class GLTFBuilder:
+    def __init__(self, generator="Meshcapade SMPL Blender addon"):
+        self.gltf = {
+            "asset": {"version": "2.0", "generator": generator},
+            "scene": 0,
+            "scenes": [{"nodes": []}],
+            "nodes": [],
+            "meshes": [],
+            "skins": [],
+            "animations": [],
+            "accessors": [],
+            "bufferViews": [],
+            "buffers": [],
+        }
+        # (byte offset, array) of every buffer view, in file order
+        self._arrays = []
+        self._byte_length = 0
+
+    def _add(self, key, item):
+        self.gltf[key].append(item)
+        return len(self.gltf[key]) - 1
+
+    def add_buffer_view(self, array, target=None):
+        # Float64 and int64 arrays are converted, everything else is referenced as is
+        if array.dtype == np.float64:
+            array = array.astype(np.float32)
+        elif array.dtype == np.int64:
+            array = array.astype(np.uint32)
+        array = np.ascontiguousarray(array)
+        if array.dtype not in COMPONENT_TYPES:
+            raise ValueError(f"Unsupported glTF component type: {array.dtype}")
+
+        self._byte_length += _padding(self._byte_length)
+        buffer_view = {
+            "buffer": 0,
+            "byteOffset": self._byte_length,
+            "byteLength": array.nbytes,
+        }
+        if target is not None:
+            buffer_view["target"] = target
+
+        self._arrays.append((self._byte_length, array))
+        self._byte_length += array.nbytes
+        return (self._add("bufferViews", buffer_view), array)
+
+    def add_accessor(self, array, target=None, min_max=False):
+        # array: (count,) scalars, (count, n) vectors or (count, 4, 4) row-major matrices.
+        # glTF matrices are column-major, so matrices are transposed.
+        array = np.asarray(array)
+        if array.ndim == 3:
+            array = array.transpose(0, 2, 1).reshape(len(array), -1)
+        num_components = 1 if array.ndim == 1 else array.shape[1]
+
+        (buffer_view, array) = self.add_buffer_view(array, target)
+        accessor = {
+            "bufferView": buffer_view,
+            "componentType": COMPONENT_TYPES[array.dtype],
+            "count": len(array),
+            "type": ACCESSOR_TYPES[num_components],
+        }
+        if min_max:
+            values = array.reshape(len(array), num_components)
+            accessor["min"] = values.min(axis=0).tolist()
+            accessor["max"] = values.max(axis=0).tolist()
+
+        return self._add("accessors", accessor)
+
+    def add_node(self, root=False, **node):
+        index = self._add("nodes", node)
+        if root:
+            self.gltf["scenes"][0]["nodes"].append(index)
+        return index
+
+    def add_mesh(self, positions, indices, normals=None, uvs=None, joints=None, weights=None,
+                 morph_targets=None, morph_names=None, morph_weights=None, name=None):
+        # One triangle primitive. morph_targets: list of (num_vertices, 3) position offsets.
+        attributes = {"POSITION": self.add_accessor(positions, TARGET_ARRAY_BUFFER, min_max=True)}
+        if normals is not None:
+            attributes["NORMAL"] = self.add_accessor(normals, TARGET_ARRAY_BUFFER)
+        if uvs is not None:
+            attributes["TEXCOORD_0"] = self.add_accessor(uvs, TARGET_ARRAY_BUFFER)
+        if joints is not None:
+            attributes["JOINTS_0"] = self.add_accessor(joints, TARGET_ARRAY_BUFFER)
+            attributes["WEIGHTS_0"] = self.add_accessor(weights, TARGET_ARRAY_BUFFER)
+
+        primitive = {
+            "attributes": attributes,
+            "indices": self.add_accessor(indices, TARGET_ELEMENT_ARRAY_BUFFER),
+            "mode": 4,
+        }
+
+        mesh = {"primitives": [primitive]}
+        if name is not None:
+            mesh["name"] = name
+
+        if morph_targets:
+            # POSITION accessors of morph targets need min and max
+            primitive["targets"] = [{"POSITION": self.add_accessor(target, TARGET_ARRAY_BUFFER, min_max=True)} for target in morph_targets]
+            mesh["weights"] = [float(weight) for weight in (morph_weights if morph_weights is not None else np.zeros(len(morph_targets)))]
+            if morph_names is not None:
+                mesh["extras"] = {"targetNames": list(morph_names)}
+
+        return self._add("meshes", mesh)
+
+    def add_skin(self, joints, inverse_bind_matrices, skeleton=None, name=None):
+        skin = {
+            "joints": list(joints),
+            "inverseBindMatrices": self.add_accessor(inverse_bind_matrices),
+        }
+        if skeleton is not None:
+            skin["skeleton"] = skeleton
+        if name is not None:
+            skin["name"] = name
+        return self._add("skins", skin)
+
+    def add_animation(self, times, channels, name=None):
+        # times: (num_keyframes,) seconds shared by all channels.
+        # channels: list of (node, path, values) with path "translation", "rotation" (x, y, z, w), "scale" or
+        # "weights", and values of shape (num_keyframes, n), for "weights" (num_keyframes, num_morph_targets).
+        if not channels:
+            return None
+
+        input_accessor = self.add_accessor(np.asarray(times, dtype=np.float32), min_max=True)
+        samplers = []
+        animation_channels = []
+        for (node, path, values) in channels:
+            values = np.asarray(values)
+            if path == "weights":
+                values = values.reshape(-1)
+            animation_channels.append({"sampler": len(samplers), "target": {"node": node, "path": path}})
+            samplers.append({"input": input_accessor, "output": self.add_accessor(values), "interpolation": "LINEAR"})
+
+        animation = {"channels": animation_channels, "samplers": samplers}
+        if name is not None:
+            animation["name"] = name
+        return self._add("animations", animation)
+
+    def to_json(self):
+        # Top level arrays must not be empty
+        gltf = {key: value for (key, value) in self.gltf.items() if not (isinstance(value, list) and len(value) == 0)}
+        if self._byte_length > 0:
+            gltf["buffers"] = [{"byteLength": self._byte_length + _padding(self._byte_length)}]
+        return gltf
+
+    def write_glb(self, path):
+        json_chunk = json.dumps(self.to_json(), separators=(",", ":")).encode("utf-8")
+        json_chunk += b" " * _padding(len(json_chunk))
+        bin_length = self._byte_length + _padding(self._byte_length)
+
+        total_length = 12 + 8 + len(json_chunk)
+        if bin_length > 0:
+            total_length += 8 + bin_length
+
+        with open(path, "wb") as f:
+            f.write(struct.pack("<III", GLB_MAGIC, GLB_VERSION, total_length))
+            f.write(struct.pack("<II", len(json_chunk), CHUNK_JSON))
+            f.write(json_chunk)
+
+            if bin_length > 0:
+                f.write(struct.pack("<II", bin_length, CHUNK_BIN))
+                position = 0
+                for (offset, array) in self._arrays:
+                    f.write(b"\0" * (offset - position))
+                    f.write(memoryview(array).cast("B"))
+                    position = offset + array.nbytes
+                f.write(b"\0" * (bin_length - position))
+
+        return total_length
@@ -0,0 +1,87 @@
+# Input discovery and manifests for batch conversion.
+#
+# Standard library only and without relative imports, so that scripts/batch_farm.py can load this file
+# outside of Blender.
+import ast
+import json
+import os
+import struct
+import zipfile
+
+
+def collect_inputs(paths):
+    # Returns a sorted list of (input_path, input_root) for .npz files, directories (searched recursively)
+    # and manifest files (.txt with one path per line, .json list or .jsonl with {"input": path} lines).
+    # input_root is used to mirror the input folder structure in the output folder.
+    inputs = []
+    for path in paths:
+        path = os.path.abspath(path)
+
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for file in sorted(files):
+                    if file.endswith(".npz"):
+                        inputs.append((os.path.join(root, file), path))
+
+        elif path.endswith(".npz"):
+            inputs.append((path, os.path.dirname(path)))
+
+        else:
+            inputs.extend(read_manifest(path))
+
+    return sorted(set(inputs))
+
+
+def read_manifest(path):
+    # Entries can carry their own "root", otherwise the common folder of all entries is used
+    manifest_dir = os.path.dirname(os.path.abspath(path))
+
+    with open(path) as f:
+        if path.endswith(".json"):
+            entries = json.load(f)
+        elif path.endswith(".jsonl"):
+            entries = [json.loads(line) for line in f if line.strip()]
+        else:
+            entries = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+    paths = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            paths.append((os.path.normpath(os.path.join(manifest_dir, entry["input"])), entry.get("root")))
+        else:
+            paths.append((os.path.normpath(os.path.join(manifest_dir, entry)), None))
+
+    if not paths:
+        return []
+
+    common_root = os.path.commonpath([os.path.dirname(p) for (p, _) in paths])
+    return [(p, root if root is not None else common_root) for (p, root) in paths]
+
+
+def write_manifest(path, inputs):
+    with open(path, "w") as f:
+        for (input_path, input_root) in inputs:
+            f.write(json.dumps({"input": input_path, "root": input_root}) + "\n")
+
+
+def output_path_for(input_path, input_root, output_dir, export_type):
+    relative_path = os.path.relpath(input_path, input_root) if input_root else os.path.basename(input_path)
+    return os.path.join(output_dir, os.path.splitext(relative_path)[0] + "." + export_type)
+
+
+def npz_num_frames(path, key="poses"):
+    # Reads the number of frames from the .npy header of an .npz member without NumPy
+    with zipfile.ZipFile(path) as archive:
+        with archive.open(key + ".npy") as f:
+            magic = f.read(8)
+            if magic[:6] != b"\x93NUMPY":
+                raise ValueError(f"'{key}' in {path} is not a .npy array")
+
+            if magic[6] == 1:
+                (header_length,) = struct.unpack("<H", f.read(2))
+            else:
+                (header_length,) = struct.unpack("<I", f.read(4))
+
+            header = ast.literal_eval(f.read(header_length).decode("latin1"))
+            shape = header["shape"]
+            return shape[0] if shape else 1
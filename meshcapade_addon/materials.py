@@ -0,0 +1,279 @@
+# Shared avatar materials.
+#
+# The textures use the same UV layout for all SMPL versions, so every texture selection is built once per
+# session into a material which all avatars with that selection use. Setting the texture of an avatar only
+# swaps the material reference, and the shader of every material is compiled only once. The texture images
+# are loaded with check_existing, so every map is only decoded once no matter how many avatars are created.
+#
+# For viewport work the texture maps can be used as downscaled proxies, which are generated once and cached
+# in data/proxy (or the temp folder if the addon folder is not writable). Final renders swap the proxies for
+# the full resolution images and back, see the render handlers at the end of this file.
+import bpy
+from bpy.app.handlers import persistent
+import os
+import tempfile
+
+from .globals import (
+    PATH,
+)
+
+# Custom property on the materials built here, to recognize them by more than their name
+MATERIAL_KEY_PROPERTY = "smpl_material"
+
+MATERIAL_NAME_PREFIX = "SMPL-texture-"
+
+PROXY_DIRECTORIES = [
+    os.path.join(PATH, "data", "proxy"),
+    os.path.join(tempfile.gettempdir(), "smpl_texture_proxies"),
+]
+
+# Custom property on proxy images with the path of their full resolution image
+FULL_RESOLUTION_PATH_PROPERTY = "full_resolution_path"
+
+# Resolution divisor of the proxies while a final render uses the full resolution textures, None otherwise
+_render_divisor = None
+
+
+def load_image(path, colorspace):
+    # Returns the image datablock of path, loading it only if it is not loaded yet
+    image = bpy.data.images.load(path, check_existing=True)
+    if image.colorspace_settings.name != colorspace:
+        image.colorspace_settings.name = colorspace
+    return image
+
+
+def proxy_file_name(path, divisor):
+    # e.g. "m_albedo.png" -> "m_albedo_4.png"
+    (name, extension) = os.path.splitext(os.path.basename(path))
+    return f"{name}_{divisor}{extension}"
+
+
+def generate_proxy_image(path, divisor):
+    # Downscales the image at path by divisor and saves it into the first writable proxy directory.
+    # Returns the path of the proxy file.
+    image = bpy.data.images.load(path, check_existing=False)
+    try:
+        (width, height) = image.size
+        image.scale(max(1, width // divisor), max(1, height // divisor))
+
+        for directory in PROXY_DIRECTORIES:
+            proxy_path = os.path.join(directory, proxy_file_name(path, divisor))
+            try:
+                os.makedirs(directory, exist_ok=True)
+                image.filepath_raw = proxy_path
+                image.file_format = 'PNG'
+                image.save()
+                return proxy_path
+            except (OSError, RuntimeError) as error:
+                print(f"WARNING: Could not save texture proxy to {directory}: {error}")
+    finally:
+        bpy.data.images.remove(image)
+
+    raise RuntimeError(f"Could not save texture proxy of {path}")
+
+
+def load_texture_image(path, colorspace, divisor=1):
+    # Returns the image of path, or of its cached proxy downscaled by divisor
+    if divisor <= 1:
+        return load_image(path, colorspace)
+
+    proxy_path = None
+    for directory in PROXY_DIRECTORIES:
+        candidate = os.path.join(directory, proxy_file_name(path, divisor))
+        if os.path.exists(candidate) and (os.path.getmtime(candidate) >= os.path.getmtime(path)):
+            proxy_path = candidate
+            break
+
+    if proxy_path is None:
+        proxy_path = generate_proxy_image(path, divisor)
+
+    image = load_image(proxy_path, colorspace)
+    image[FULL_RESOLUTION_PATH_PROPERTY] = path
+    return image
+
+
+def add_image_node(node_tree, image, location):
+    node = node_tree.nodes.new(type="ShaderNodeTexImage")
+    node.location = location
+    node.image = image
+    return node
+
+
+def build_skin_material(material, selection, divisor=1):
+    # Principled BSDF with the albedo, roughness and normal map of the male ('m') or female ('f') texture
+    node_tree = material.node_tree
+    nodes = node_tree.nodes
+
+    # Set the path to the texture files
+    albedo_map_path = os.path.join(PATH, "data", selection + "_albedo.png")
+    normal_map_path = os.path.join(PATH, "data", selection + "_normal.png")
+    roughness_map_path = os.path.join(PATH, "data", selection + "_roughness.png")
+
+    # Create a new Principled BSDF node
+    principled_node = nodes.new(type="ShaderNodeBsdfPrincipled")
+    principled_node.location = 0, 0
+
+    # Add a texture node for the albedo map
+    albedo_map_node = add_image_node(node_tree, load_texture_image(albedo_map_path, 'sRGB', divisor), (-400, 200))
+    node_tree.links.new(albedo_map_node.outputs["Color"], principled_node.inputs["Base Color"])
+
+    # Add a texture node for the roughness map
+    roughness_map_node = add_image_node(node_tree, load_texture_image(roughness_map_path, 'Non-Color', divisor), (-400, -200))
+    node_tree.links.new(roughness_map_node.outputs["Color"], principled_node.inputs["Roughness"])
+
+    # Add a texture node for the normal map
+    normal_map_node = add_image_node(node_tree, load_texture_image(normal_map_path, 'Non-Color', divisor), (-800, -600))
+    normal_map_adjustment = nodes.new('ShaderNodeNormalMap')
+    normal_map_adjustment.location = -400, -600
+    node_tree.links.new(normal_map_node.outputs["Color"], normal_map_adjustment.inputs["Color"])
+    node_tree.links.new(normal_map_adjustment.outputs["Normal"], principled_node.inputs["Normal"])
+
+    # TODO add AO (ao.png) and thickness (thickness.png)
+
+    # Set the subsurface properties
+    principled_node.inputs["Subsurface"].default_value = 0.001
+    principled_node.inputs["Subsurface Color"].default_value = (1, 0, 0, 1)
+
+    return principled_node
+
+
+def build_texture_material(material, texture_name, divisor=1):
+    # Principled BSDF with an optional base color texture: 'NONE', a generated 'UV_GRID'/'COLOR_GRID' or an image in the data folder
+    node_tree = material.node_tree
+    principled_node = node_tree.nodes.new(type="ShaderNodeBsdfPrincipled")
+    principled_node.location = 0, 0
+
+    if texture_name == 'NONE':
+        return principled_node
+
+    if texture_name in ('UV_GRID', 'COLOR_GRID'):
+        image = bpy.data.images.get(texture_name)
+        if image is None:
+            image = bpy.data.images.new(name=texture_name, width=1024, height=1024)
+            image.generated_type = texture_name
+    else:
+        image = load_texture_image(os.path.join(PATH, "data", texture_name), 'sRGB', divisor)
+
+    texture_node = add_image_node(node_tree, image, (-400, 200))
+    node_tree.links.new(texture_node.outputs["Color"], principled_node.inputs["Base Color"])
+    return principled_node
+
+
+def material_name(selection):
+    # e.g. "SMPL-texture-m" or "SMPL-texture-UV_GRID"
+    return MATERIAL_NAME_PREFIX + selection.replace(".png", "")
+
+
+def find_avatar_material(selection):
+    # Looked up by name on every call, references become invalid after undo or loading another file
+    material = bpy.data.materials.get(material_name(selection))
+    if (material is None) or (material.get(MATERIAL_KEY_PROPERTY) != selection):
+        return None
+    return material
+
+
+def get_avatar_material(selection, divisor=1):
+    # Returns the shared material of a texture selection, building it on first use.
+    # divisor > 1 uses texture proxies with 1/divisor of the full resolution.
+    material = find_avatar_material(selection)
+    if material is not None:
+        set_material_resolution(material, divisor)
+        return material
+
+    material = bpy.data.materials.new(name=material_name(selection))
+    material[MATERIAL_KEY_PROPERTY] = selection
+    material.use_nodes = True
+    node_tree = material.node_tree
+
+    # Clear default nodes
+    for node in list(node_tree.nodes):
+        node_tree.nodes.remove(node)
+
+    if selection in ('m', 'f'):
+        principled_node = build_skin_material(material, selection, divisor)
+    else:
+        principled_node = build_texture_material(material, selection, divisor)
+
+    # Link the output of the Principled BSDF node to the material output
+    output_node = node_tree.nodes.new(type="ShaderNodeOutputMaterial")
+    output_node.location = 400, 0
+    node_tree.links.new(principled_node.outputs["BSDF"], output_node.inputs["Surface"])
+
+    return material
+
+
+def assign_material(obj, material):
+    # Puts the material into the first slot of the mesh
+    if len(obj.data.materials) == 0:
+        obj.data.materials.append(material)
+    else:
+        obj.data.materials[0] = material
+
+
+def set_material_resolution(material, divisor):
+    # Switches the image file textures of a material between full resolution (divisor 1) and proxies
+    for node in material.node_tree.nodes:
+        image = node.image if node.type == 'TEX_IMAGE' else None
+        if (image is None) or (image.source != 'FILE'):
+            continue
+
+        path = image.get(FULL_RESOLUTION_PATH_PROPERTY, bpy.path.abspath(image.filepath))
+        if not os.path.exists(path):
+            continue
+
+        resized = load_texture_image(path, image.colorspace_settings.name, divisor)
+        if resized != image:
+            node.image = resized
+
+            # Pixels of images which are not used anymore would stay in memory until the file is reloaded
+            if image.users == 0:
+                image.buffers_free()
+
+
+def set_texture_resolution(divisor):
+    # Switches all shared avatar materials to the given texture resolution
+    for material in bpy.data.materials:
+        if (material.get(MATERIAL_KEY_PROPERTY) is not None) and (material.node_tree is not None):
+            set_material_resolution(material, divisor)
+
+
+def texture_proxy_divisor(context):
+    return int(context.window_manager.smpl_tool.texture_resolution)
+
+
+@persistent
+def render_pre(*args):
+    # Final renders use the full resolution textures. Called for every frame of an animation render.
+    global _render_divisor
+    divisor = texture_proxy_divisor(bpy.context)
+    if (_render_divisor is None) and (divisor > 1):
+        _render_divisor = divisor
+        set_texture_resolution(1)
+
+
+@persistent
+def render_complete(*args):
+    # Back to the proxies after the render job finished or was cancelled
+    global _render_divisor
+    if _render_divisor is not None:
+        set_texture_resolution(_render_divisor)
+        _render_divisor = None
+
+
+RENDER_HANDLERS = [
+    (bpy.app.handlers.render_pre, render_pre),
+    (bpy.app.handlers.render_complete, render_complete),
+    (bpy.app.handlers.render_cancel, render_complete),
+]
+
+
+def register_render_handlers():
+    for (handlers, handler) in RENDER_HANDLERS:
+        if handler not in handlers:
+            handlers.append(handler)
+
+
+def unregister_render_handlers():
+    for (handlers, handler) in RENDER_HANDLERS:
+        if handler in handlers:
+            handlers.remove(handler)
@@ -1,14 +1,23 @@
 import bpy
 from . import (
+    blender,
+    body_model,
+    materials,
     properties,
     ui,
     operators,
+    regressors,
+    scheduler,
+    templates,
 )
 
 
 handle_shape_key_change=object()
 def shape_key_change(*args):
-    bpy.ops.object.update_joint_locations('EXEC_DEFAULT')
+    # Only marks the mesh, the joint locations are updated once per mesh on the next timer tick
+    obj = bpy.context.object
+    if (obj is not None) and (obj.type == 'MESH'):
+        scheduler.mark_dirty(obj)
 
 
 def register():
@@ -22,6 +31,9 @@ def register():
         bpy.utils.register_class(operator)
 
     properties.define_props()
+    materials.register_render_handlers()
+    templates.register_handlers()
+    scheduler.register_handlers()
 
 
     #subscribe to changes of the shape keys and call the function to update the joint locations
@@ -35,6 +47,9 @@ def register():
 
 
 def unregister():
+    materials.unregister_render_handlers()
+    templates.unregister_handlers()
+    scheduler.unregister_handlers()
     properties.destroy_props()
 
     for operator in reversed(operators.OPERATORS):
@@ -47,4 +62,9 @@ def unregister():
         bpy.utils.unregister_class(prop_class)
 
     bpy.msgbus.clear_by_owner(handle_shape_key_change)
+    scheduler.clear()
+
+    regressors.clear_regressor_cache()
+    body_model.clear_body_model_cache()
+    blender.clear_key_block_index_cache()
 
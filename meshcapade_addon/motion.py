@@ -0,0 +1,190 @@
+# Reading and resampling of motion sequences from .npz files.
+#
+# Pure NumPy. Very long motion capture sessions do not fit into memory as a whole, so the arrays of an
+# .npz archive can be read in chunks of frames: uncompressed members are memory-mapped, compressed
+# members are decompressed incrementally.
+import struct
+import zipfile
+
+import numpy as np
+
+from .rotations import (
+    rodrigues_to_quat,
+    quat_slerp,
+)
+
+ZIP_LOCAL_HEADER_SIZE = 30
+
+
+def _read_npy_header(f):
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        (shape, fortran_order, dtype) = np.lib.format.read_array_header_1_0(f)
+    elif version == (2, 0):
+        (shape, fortran_order, dtype) = np.lib.format.read_array_header_2_0(f)
+    else:
+        raise ValueError(f"Unsupported .npy format version: {version}")
+    return (shape, fortran_order, dtype)
+
+
+def npz_array_shape(path, key):
+    # Returns the shape of an .npz member without reading its data
+    with zipfile.ZipFile(path) as archive:
+        with archive.open(key + ".npy") as f:
+            return _read_npy_header(f)[0]
+
+
+def _npz_member_memmap(archive, path, info):
+    # Memory-maps an uncompressed .npz member. The data offset is the local file header, followed by
+    # file name, extra field and the .npy header.
+    with open(path, "rb") as f:
+        f.seek(info.header_offset)
+        local_header = f.read(ZIP_LOCAL_HEADER_SIZE)
+        (name_length, extra_length) = struct.unpack("<HH", local_header[26:30])
+        member_offset = info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_length + extra_length
+
+    with archive.open(info) as f:
+        (shape, fortran_order, dtype) = _read_npy_header(f)
+        data_offset = member_offset + f.tell()
+
+    if fortran_order or dtype.hasobject or (len(shape) == 0):
+        return None
+
+    return np.memmap(path, dtype=dtype, mode='r', offset=data_offset, shape=shape)
+
+
+def iter_npz_chunks(path, key, chunk_size):
+    # Yields (start_frame, array) chunks of at most chunk_size frames along the first axis of an .npz member
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(key + ".npy")
+
+        if info.compress_type == zipfile.ZIP_STORED:
+            data = _npz_member_memmap(archive, path, info)
+            if data is not None:
+                for start in range(0, data.shape[0], chunk_size):
+                    yield (start, np.array(data[start:start + chunk_size]))
+                return
+
+        with archive.open(info) as f:
+            (shape, fortran_order, dtype) = _read_npy_header(f)
+
+            if fortran_order or dtype.hasobject or (len(shape) == 0):
+                # Cannot be read row by row, fall back to reading the whole member
+                data = np.load(f, allow_pickle=False)
+                for start in range(0, max(len(data), 1), chunk_size):
+                    yield (start, data[start:start + chunk_size])
+                return
+
+            row_shape = shape[1:]
+            row_bytes = int(np.prod(row_shape, dtype=np.int64)) * dtype.itemsize
+
+            for start in range(0, shape[0], chunk_size):
+                num_rows = min(chunk_size, shape[0] - start)
+                buffer = f.read(num_rows * row_bytes)
+                if len(buffer) != num_rows * row_bytes:
+                    raise ValueError(f"Unexpected end of data in '{key}' of {path}")
+                yield (start, np.frombuffer(buffer, dtype=dtype).reshape((num_rows,) + row_shape))
+
+
+def iter_motion_chunks(path, chunk_size):
+    # Yields (start_frame, poses, trans) chunks of an AMASS style .npz file
+    for ((start, poses), (_, trans)) in zip(
+        iter_npz_chunks(path, "poses", chunk_size),
+        iter_npz_chunks(path, "trans", chunk_size),
+    ):
+        yield (start, poses, trans)
+
+
+def resample_positions(num_frames, source_fps, target_fps):
+    # Returns the (fractional) source frame index of every target frame inside the clip duration
+    duration = (num_frames - 1) / source_fps
+    num_target_frames = int(np.floor(duration * target_fps + 1e-6)) + 1
+    return np.arange(num_target_frames) * (source_fps / target_fps)
+
+
+def iter_resampled_chunks(chunks, num_frames, source_fps, target_fps, num_joints):
+    # Resamples (start_frame, poses, trans) chunks to the target framerate.
+    # Rotations are interpolated with SLERP and translations linearly, so arbitrary framerate ratios
+    # (e.g. 59.94 -> 24 fps) keep their timing and upsampling works as well.
+    # Yields (target_start_frame, quats, trans) with quats of shape (num_target_frames, num_joints, 4).
+    positions = resample_positions(num_frames, source_fps, target_fps)
+    next_target = 0
+    previous = None
+
+    for (start, poses, trans) in chunks:
+        quats = rodrigues_to_quat(np.asarray(poses).reshape(len(poses), -1, 3)[:, :num_joints])
+        trans = np.asarray(trans, dtype=np.float64)
+
+        # Prepend the last frame of the previous chunk so that target frames between two chunks can be interpolated
+        if previous is not None:
+            quats = np.concatenate((previous[0], quats))
+            trans = np.concatenate((previous[1], trans))
+            start = start - 1
+        previous = (quats[-1:], trans[-1:])
+
+        end = start + len(quats) - 1
+        num_chunk_targets = np.searchsorted(positions, end, side='right') - next_target
+        if num_chunk_targets <= 0:
+            continue
+
+        chunk_positions = positions[next_target:next_target + num_chunk_targets]
+        index0 = np.floor(chunk_positions).astype(np.int64)
+        t = (chunk_positions - index0)[:, None]
+        index0 = index0 - start
+        index1 = np.minimum(index0 + 1, len(quats) - 1)
+
+        resampled_quats = quat_slerp(quats[index0], quats[index1], t[:, None])
+        resampled_trans = (1.0 - t) * trans[index0] + t * trans[index1]
+
+        yield (next_target, resampled_quats, resampled_trans)
+        next_target += num_chunk_targets
+
+
+def reduce_keyframes(values, tolerance, rotation=False):
+    # Ramer-Douglas-Peucker reduction of a (num_frames, num_channels) curve.
+    # Returns a boolean mask of the keyframes to keep so that linear interpolation between the kept
+    # keyframes deviates at most tolerance from every dropped keyframe. For rotation=True the values
+    # are (w, x, y, z) quaternions and tolerance is the rotation angle in radians.
+    values = np.asarray(values, dtype=np.float64)
+    num_frames = values.shape[0]
+    keep = np.zeros(num_frames, dtype=bool)
+    keep[0] = True
+    keep[-1] = True
+
+    segments = [(0, num_frames - 1)]
+    while segments:
+        (first, last) = segments.pop()
+        if last - first < 2:
+            continue
+
+        t = (np.arange(first + 1, last) - first)[:, None] / (last - first)
+        interpolated = (1.0 - t) * values[first] + t * values[last]
+        original = values[first + 1:last]
+
+        if rotation:
+            # Blender interpolates the quaternion channels independently and normalizes the result
+            interpolated = interpolated / np.linalg.norm(interpolated, axis=-1, keepdims=True)
+            dot = np.abs(np.sum(interpolated * original, axis=-1)) / np.linalg.norm(original, axis=-1)
+            error = 2.0 * np.arccos(np.clip(dot, 0.0, 1.0))
+        else:
+            error = np.linalg.norm(original - interpolated, axis=-1)
+
+        index = int(np.argmax(error))
+        if error[index] > tolerance:
+            split = first + 1 + index
+            keep[split] = True
+            segments.append((first, split))
+            segments.append((split, last))
+
+    return keep
+
+
+def reduce_pose_sequence(quats, locations, rotation_tolerance, location_tolerance):
+    # Returns keep masks for (num_frames, num_joints, 4) joint rotations and (num_frames, 3) locations.
+    # quats should be sign continuous over time, see rotations.quat_continuous().
+    rotation_keep = np.stack(
+        [reduce_keyframes(quats[:, joint_index], rotation_tolerance, rotation=True) for joint_index in range(quats.shape[1])],
+        axis=1,
+    )
+    location_keep = reduce_keyframes(locations, location_tolerance)
+    return (rotation_keep, location_keep)
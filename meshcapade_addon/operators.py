@@ -2,41 +2,127 @@ import bpy
 import os
 import numpy as np
 import json
-import copy
 import pickle
 
 from bpy.props import (
     BoolProperty,
     StringProperty,
     EnumProperty,
-    IntProperty
+    IntProperty,
+    FloatProperty,
 )
 from bpy_extras.io_utils import (
     ImportHelper,
     ExportHelper,
 )
 from .globals import (
-    SMPLX_MODELFILE,
-    SMPLH_MODELFILE,
-    SUPR_MODELFILE,
-    PATH,
+    EXPORT_TYPE,
     LEFT_HAND_RELAXED,
     RIGHT_HAND_RELAXED,
     MODEL_JOINT_NAMES,
     MODEL_BODY_JOINTS,
     MODEL_HAND_JOINTS,
+    NUM_BODY_SHAPES,
 )
 from .blender import (
     set_pose_from_rodrigues,
-    rodrigues_from_pose,
-    setup_bone,
+    pose_from_armature,
+    set_joint_locations,
     correct_for_anim_format,
     key_all_pose_correctives,
+    keyframe_pose_sequence,
+    set_key_block_values,
+    num_key_blocks,
+    betas_from_mesh,
+    bake_pose_correctives,
+    sole_heights,
+    write_fcurve,
+    evaluated_vertex_coordinates,
+    export_avatar,
+    export_glb,
+)
+from .correctives import (
+    pose_corrective_weights,
+)
+from .materials import (
+    assign_material,
+    get_avatar_material,
+)
+from .motion import (
+    npz_array_shape,
+    iter_motion_chunks,
+    iter_resampled_chunks,
+    resample_positions,
+    reduce_pose_sequence,
+)
+from .regressors import (
+    load_measurements_to_betas,
+    regress_joint_locations,
+)
+from .rotations import (
+    quat_continuous,
+)
+from .scheduler import (
+    joint_cache_key,
+)
+from .templates import (
+    get_body_model,
+    get_template,
+    instantiate_template,
+    instantiate_shared_template,
 )
 
-from mathutils import Vector, Quaternion
+from mathutils import Quaternion
 from math import radians
 
+
+def has_shape_keys(obj):
+    # Shared mesh avatars have no shape keys, see templates.set_shared_shape()
+    if obj.type == 'ARMATURE':
+        if len(obj.children) == 0:
+            return False
+        obj = obj.children[0]
+    return (obj.type == 'MESH') and (obj.data.shape_keys is not None)
+
+
+def create_avatar(context, shared_mesh=False, betas=()):
+    # Creates an avatar of the version and gender selected in the tool properties and makes it the active object.
+    # Shared mesh avatars get the body shape of the betas right away, so their mesh is baked only once.
+    gender = context.window_manager.smpl_tool.gender
+    SMPL_version = context.window_manager.smpl_tool.SMPL_version
+
+    # The model file is only read for the first avatar of every version and gender, see templates.py
+    template = get_template(SMPL_version, gender)
+    if shared_mesh:
+        obj = instantiate_shared_template(template, context.collection, SMPL_version, gender, betas)
+    else:
+        obj = instantiate_template(template, context.collection)
+
+    # Select new mesh
+    bpy.ops.object.select_all(action='DESELECT')
+    context.view_layer.objects.active = obj
+    obj.select_set(True)
+
+    #define custom properties on the avatar itself to store this kind of data so we can use it whenever we need to
+    bpy.context.object['gender'] = gender
+    bpy.context.object['SMPL_version'] = SMPL_version
+
+    # add a texture and change the texture option based on the gender
+    # male texture if it's a male, female texture if it's female or neutral
+    if gender == 'male':
+        context.window_manager.smpl_tool.texture = "m"
+    else:
+        context.window_manager.smpl_tool.texture = "f"
+
+    bpy.ops.object.set_texture()
+
+    # Shared meshes have no shape keys to reset
+    if not shared_mesh:
+        bpy.ops.object.reset_body_shape('EXEC_DEFAULT')
+
+    return obj
+
+
 class OP_LoadAvatar(bpy.types.Operator, ImportHelper):
     bl_idname = "object.load_avatar"
     bl_label = "Load Avatar"
@@ -87,18 +173,63 @@ class OP_LoadAvatar(bpy.types.Operator, ImportHelper):
 
     keyframe_corrective_pose_weights: BoolProperty(
         name="Use keyframed corrective pose weights",
-        description="Keyframe the weights of the corrective pose shapes for each frame. This increases animation load time and slows down editor real-time playback.",
+        description="Keyframe the weights of the corrective pose shapes for each frame. This slows down editor real-time playback.",
         default=False
     )
 
     target_framerate: IntProperty(
         name="Target framerate [fps]",
-        description="Target framerate for animation in frames-per-second. Lower values will speed up import time.",
+        description="Target framerate for animation in frames-per-second. The motion is resampled to this framerate, lower values will speed up import time.",
         default=30,
         min = 1,
         max = 120
     )
 
+    reduce_keyframes: BoolProperty(
+        name="Reduce keyframes",
+        description="Only keep the keyframes that are needed to reproduce the motion within the tolerances below. Smaller files and faster playback.",
+        default=False
+    )
+
+    rotation_tolerance: FloatProperty(
+        name="Rotation tolerance [deg]",
+        description="Maximum joint rotation error of keyframe reduction",
+        default=0.5,
+        min = 0.0,
+        max = 10.0
+    )
+
+    location_tolerance: FloatProperty(
+        name="Location tolerance [cm]",
+        description="Maximum pelvis location error of keyframe reduction",
+        default=0.1,
+        min = 0.0,
+        max = 10.0
+    )
+
+    ground_snapping: EnumProperty(
+        name="Ground Snapping",
+        items=(
+            ("CURRENT", "First frame", "Put the lowest vertex of the first frame onto the ground plane"),
+            ("CONSTANT", "Whole animation", "Put the feet onto the ground plane at the lowest frame of the animation"),
+            ("PER_FRAME", "Every frame", "Keyframe the avatar height so that its feet touch the ground plane on every frame"),
+        ),
+        default="CURRENT",
+    )
+
+    shared_mesh: BoolProperty(
+        name="Shared mesh (crowds)",
+        description="Avatars with the same betas share one mesh without shape keys. Uses much less memory for large crowds, but the body shape cannot be edited and pose correctives are not available",
+        default=False
+    )
+
+    streaming_chunk_size: IntProperty(
+        name="Streaming chunk size [frames]",
+        description="Read the source motion in chunks of this many frames instead of the whole file. The resampled rotations are still kept in memory until the F-curves are written, 16 bytes per joint and frame (about 0.9 MB per 1000 SMPL-X frames) on top of the keyframes themselves. 0 reads the whole file at once.",
+        default=0,
+        min = 0
+    )
+
     @classmethod
     def poll(cls, context):
         return True
@@ -127,7 +258,7 @@ class OP_LoadAvatar(bpy.types.Operator, ImportHelper):
             if not fps_key:
                 error_string += "\n -fps or mocap_framerate or mocap_frame_rate"
             else: 
-                fps = int(data[fps_key])
+                fps = float(data[fps_key])
 
             if "betas" not in data:
                 error_string += "\n -betas"
@@ -139,19 +270,20 @@ class OP_LoadAvatar(bpy.types.Operator, ImportHelper):
                 self.report({"ERROR"}, "the following keys are missing from the .npz: " + error_string)
                 return {"CANCELLED"}
 
-            trans = data["trans"]
-
             if self.gender_override != "disabled":
                 gender = self.gender_override
             else:
                 gender = str(data["gender"])
 
             betas = data["betas"]
-            poses = data["poses"]
 
-            if fps < target_framerate:
-                self.report({"ERROR"}, f"Mocap framerate ({fps}) below target framerate ({target_framerate})")
-                return {"CANCELLED"}
+            if self.streaming_chunk_size > 0:
+                # Only read the array shape here, the frames are read chunk by chunk when keyframing
+                num_frames = npz_array_shape(self.filepath, "trans")[0]
+            else:
+                trans = data["trans"]
+                poses = data["poses"]
+                num_frames = trans.shape[0]
             
             SMPL_version = self.SMPL_version
 
@@ -168,9 +300,8 @@ class OP_LoadAvatar(bpy.types.Operator, ImportHelper):
         if self.hand_pose != 'disabled':
             context.window_manager.smpl_tool.hand_pose = self.hand_pose
 
-        bpy.ops.scene.create_avatar()
-
-        obj = context.view_layer.objects.active
+        # Shared mesh avatars are created with their body shape, see create_avatar()
+        obj = create_avatar(context, shared_mesh=self.shared_mesh, betas=betas)
         armature = obj.parent
 
         # Append animation name to armature name
@@ -181,25 +312,23 @@ class OP_LoadAvatar(bpy.types.Operator, ImportHelper):
 
         # Set shape and update joint locations
         # TODO once we have the regressor for SMPLH, we can remove this condition
-        if SMPL_version != 'SMPLH':
+        if (not self.shared_mesh) and (SMPL_version != 'SMPLH'):
             bpy.ops.object.mode_set(mode='OBJECT')
-            for index, beta in enumerate(betas):
-                key_block_name = f"Shape{index:03}"
+            num_set = set_key_block_values(obj.data.shape_keys, "Shape", betas)
+            if num_set < len(betas):
+                print(f"ERROR: No key blocks for: Shape{num_set:03} to Shape{len(betas) - 1:03}")
 
-                if key_block_name in obj.data.shape_keys.key_blocks:
-                    obj.data.shape_keys.key_blocks[key_block_name].value = beta
-                else:
-                    print(f"ERROR: No key block for: {key_block_name}")
+        if not self.shared_mesh:
+            bpy.ops.object.update_joint_locations('EXEC_DEFAULT')
 
-        bpy.ops.object.update_joint_locations('EXEC_DEFAULT')
+        # Shared meshes have no pose corrective keys
+        keyframe_corrective_pose_weights = self.keyframe_corrective_pose_weights and not self.shared_mesh
 
         # Keyframe poses
-        step_size = int(fps / target_framerate)
-
-        num_frames = trans.shape[0]
-        num_keyframes = int(num_frames / step_size)
+        # Resample to the exact target frame times, see motion.iter_resampled_chunks()
+        num_keyframes = len(resample_positions(num_frames, fps, target_framerate))
 
-        if self.keyframe_corrective_pose_weights:
+        if keyframe_corrective_pose_weights:
             print(f"Adding pose keyframes with keyframed corrective pose weights: {num_keyframes}")
         else:
             print(f"Adding pose keyframes: {num_keyframes}")
@@ -220,32 +349,71 @@ class OP_LoadAvatar(bpy.types.Operator, ImportHelper):
             else:
                 joints_to_use = joints_to_use[:25]
 
-        for index, frame in enumerate(range(0, num_frames, step_size)):
-            if (index % 100) == 0:
-                print(f"  {index}/{num_keyframes}")
-            current_pose = poses[frame].reshape(-1, 3)
-            current_trans = trans[frame]
+        # Resample the whole sequence to quaternions at once and write the F-curves in bulk.
+        # Keyframes are stored as float32 anyway, so the buffers are too.
+        num_bones = len(joints_to_use)
+        quats = np.empty((num_keyframes, num_bones, 4), dtype=np.float32)
+        pelvis_locations = np.empty((num_keyframes, 3), dtype=np.float32)
 
-            for bone_index, bone_name in enumerate(joints_to_use):
-                if bone_name == "pelvis":
-                    # there's a scale mismatch somewhere and the global translation is off by a factor of 100
-                    armature.pose.bones[bone_name].location = current_trans*100
-                    armature.pose.bones[bone_name].keyframe_insert('location', frame=index+1)
+        if self.streaming_chunk_size > 0:
+            # Each chunk is resampled right after reading it, so only one chunk of the source motion is in memory
+            chunks = iter_motion_chunks(self.filepath, self.streaming_chunk_size)
+        else:
+            chunks = [(0, poses, trans)]
+
+        for (keyframe_start, chunk_quats, chunk_trans) in iter_resampled_chunks(chunks, num_frames, fps, target_framerate, num_bones):
+            if self.streaming_chunk_size > 0:
+                print(f"  {keyframe_start}/{num_keyframes}")
+            keyframe_range = slice(keyframe_start, keyframe_start + len(chunk_quats))
+            quats[keyframe_range] = chunk_quats
+            pelvis_locations[keyframe_range] = chunk_trans
+
+        # there's a scale mismatch somewhere and the global translation is off by a factor of 100
+        pelvis_locations *= 100
+
+        if self.reduce_keyframes:
+            # Reduced keyframes are interpolated linearly, which is what the error bound of the reduction assumes
+            quats = quat_continuous(quats)
+            (rotation_keep, location_keep) = reduce_pose_sequence(
+                quats,
+                pelvis_locations,
+                np.radians(self.rotation_tolerance),
+                self.location_tolerance,
+            )
 
-                # Keyframe bone rotation
-                set_pose_from_rodrigues(armature, bone_name, current_pose[bone_index], frame=index+1)
+            num_full = 4 * rotation_keep.size + 3 * location_keep.size
+            num_reduced = 4 * np.count_nonzero(rotation_keep) + 3 * np.count_nonzero(location_keep)
+            message = f"Keyframe reduction: {num_reduced}/{num_full} keyframes ({num_full / num_reduced:.1f}x compression)"
+            print(message)
+            self.report({"INFO"}, message)
+
+            keyframe_pose_sequence(
+                armature,
+                joints_to_use,
+                quats,
+                pelvis_locations=pelvis_locations,
+                rotation_keep=rotation_keep,
+                location_keep=location_keep,
+                interpolation='LINEAR',
+            )
+        else:
+            keyframe_pose_sequence(
+                armature,
+                joints_to_use,
+                quats,
+                pelvis_locations=pelvis_locations,
+            )
 
-            if self.keyframe_corrective_pose_weights:
-                # Calculate corrective poseshape weights for current pose and keyframe them.
-                # Note: This significantly increases animation load time and also reduces real-time playback speed in Blender viewport.
-                bpy.ops.object.set_pose_correctives('EXEC_DEFAULT')
-                key_all_pose_correctives(obj=obj, index=index+1)
+        if keyframe_corrective_pose_weights:
+            # Calculate corrective poseshape weights for every pose and keyframe them.
+            # Note: This reduces real-time playback speed in Blender viewport.
+            bake_pose_correctives(obj, armature, range(1, num_keyframes + 1))
 
         print(f"  {num_keyframes}/{num_keyframes}")
         context.scene.frame_set(1)
 
         correct_for_anim_format(self.anim_format, armature)
-        bpy.ops.object.snap_to_ground_plane('EXEC_DEFAULT')
+        bpy.ops.object.snap_to_ground_plane('EXEC_DEFAULT', mode=self.ground_snapping)
         armature.keyframe_insert(data_path="location", frame=bpy.data.scenes[0].frame_current)
 
         return {'FINISHED'}
@@ -257,6 +425,12 @@ class OP_CreateAvatar(bpy.types.Operator):
     bl_description = ("Create a SMPL family avatar at the scene origin.  \nnote: SMPLH is missing the joint regressor so you can't modify it's shape")
     bl_options = {'REGISTER', 'UNDO'}
 
+    shared_mesh: BoolProperty(
+        name="Shared mesh",
+        description="Crowd mode: avatars with the same body shape share one mesh without shape keys. Uses much less memory, but shape, expression and pose corrective keys are not available",
+        default=False
+    )
+
     @classmethod
     def poll(cls, context):
         try:
@@ -265,56 +439,14 @@ class OP_CreateAvatar(bpy.types.Operator):
         except: return False
 
     def execute(self, context):
-        gender = context.window_manager.smpl_tool.gender
-        SMPL_version = context.window_manager.smpl_tool.SMPL_version
-
-        if SMPL_version == 'SMPLX':
-            # Use 300 shape model by default if available
-            model_file = SMPLX_MODELFILE
-
-        elif SMPL_version == 'SUPR':
-            model_file = SUPR_MODELFILE
-
-        # for now, the SMPLH option has been removed from the properties because we don't have regressors for it, 
-        # so afm and a bunch of other stuff doesn't work
-        elif SMPL_version == "SMPLH":
-            model_file = SMPLH_MODELFILE
-
-        else:
-            model_file = "error bad SMPL_version"
-
-        objects_path = os.path.join(PATH, "data", model_file, "Object")
-        object_name = SMPL_version + "-mesh-" + gender
-
-        bpy.ops.wm.append(filename=object_name, directory=str(objects_path))
-
-        # Select imported mesh
-        object_name = context.selected_objects[0].name
-        bpy.ops.object.select_all(action='DESELECT')
-        context.view_layer.objects.active = bpy.data.objects[object_name]
-        bpy.data.objects[object_name].select_set(True)
-
-        #define custom properties on the avatar itself to store this kind of data so we can use it whenever we need to
-        bpy.context.object['gender'] = gender
-        bpy.context.object['SMPL_version'] = SMPL_version
-
-        # add a texture and change the texture option based on the gender
-        # male texture if it's a male, female texture if it's female or neutral
-        if gender == 'male':
-            context.window_manager.smpl_tool.texture = "m"
-        else:
-            context.window_manager.smpl_tool.texture = "f"
-
-        bpy.ops.object.set_texture()
-        bpy.ops.object.reset_body_shape('EXEC_DEFAULT')
-
+        create_avatar(context, shared_mesh=self.shared_mesh)
         return {'FINISHED'}
 
 
 class OP_SetTexture(bpy.types.Operator):
     bl_idname = "object.set_texture"
     bl_label = "Set"
-    bl_description = ("Set selected texture")
+    bl_description = ("Set selected texture on all selected avatars")
     bl_options = {'REGISTER', 'UNDO'}
 
     @classmethod
@@ -326,151 +458,19 @@ class OP_SetTexture(bpy.types.Operator):
 
     def execute(self, context):
         selection = context.window_manager.smpl_tool.texture
-        obj = bpy.context.object
 
-        # if there's no material, add one
-        if len(obj.data.materials) == 0:
-            # the incoming name of the selected object is in the format of "SUPR-mesh-male"
-            # this line turns "SUPR-mesh-male" into "SUPR-male", which is the naming format of the materials
-            split_name = obj.name.split("-")
-            new_material_name = split_name[0] + "-" + split_name[2]
-            material = bpy.data.materials.new(name=new_material_name)
-            bpy.context.object.data.materials.append(material)
-
-        else: 
-            material = obj.data.materials[0]
-
-        # Enable the use of nodes for the material
-        material.use_nodes = True
-        node_tree = material.node_tree
-        nodes = node_tree.nodes
-
-        # if they selected the male or female texture, we add the normal map and roughness map as well
-        if selection in ('m', 'f'):
-            # Set the path to the texture files
-            albedo_map_path = os.path.join(PATH, "data", selection + "_albedo.png")
-            normal_map_path = os.path.join(PATH, "data", selection + "_normal.png")
-            roughness_map_path = os.path.join(PATH, "data", selection + "_roughness.png")
-            ao_map_path = os.path.join(PATH, "data", "ao.png")
-            thickness_map_path = os.path.join(PATH, "data", "thickness.png")
-
-            # Clear default nodes
-            for node in nodes:
-                nodes.remove(node)
-
-            # Create a new Principled BSDF node
-            principled_node = nodes.new(type="ShaderNodeBsdfPrincipled")
-            principled_node.location = 0, 0
-
-            # Add a texture node for the albedo map
-            albedo_map_node = nodes.new(type="ShaderNodeTexImage")
-            albedo_map_node.location = -400, 200
-            albedo_map_node.image = bpy.data.images.load(albedo_map_path)
-            albedo_map_node.image.colorspace_settings.name = 'sRGB'
-            node_tree.links.new(albedo_map_node.outputs["Color"], principled_node.inputs["Base Color"])
-
-            # Add a texture node for the roughness map
-            roughness_map_node = nodes.new(type="ShaderNodeTexImage")
-            roughness_map_node.location = -400, -200
-            roughness_map_node.image = bpy.data.images.load(roughness_map_path)
-            roughness_map_node.image.colorspace_settings.name = 'Non-Color'
-            node_tree.links.new(roughness_map_node.outputs["Color"], principled_node.inputs["Roughness"])
-
-            # Add a texture node for the normal map
-            normal_map_node = nodes.new(type="ShaderNodeTexImage")
-            normal_map_node.location = -800, -600
-            normal_map_node.image = bpy.data.images.load(normal_map_path)
-            normal_map_node.image.colorspace_settings.name = 'Non-Color'
-            noamel_map_adjustment = material.node_tree.nodes.new('ShaderNodeNormalMap')
-            noamel_map_adjustment.location = -400, -600
-            node_tree.links.new(normal_map_node.outputs["Color"], noamel_map_adjustment.inputs["Color"])
-            node_tree.links.new(noamel_map_adjustment.outputs["Normal"], principled_node.inputs["Normal"])
+        # Materials are shared by all avatars with the same texture, so this only swaps material references
+        material = get_avatar_material(selection, int(context.window_manager.smpl_tool.texture_resolution))
+        objects = [obj for obj in context.selected_objects if obj.type == 'MESH']
+        if bpy.context.object not in objects:
+            objects.append(bpy.context.object)
 
-            '''
-            # TODO add AO
-            # Add a texture node for the ambient occlusion map
-            ambient_occlusion_node = nodes.new(type="ShaderNodeTexImage")
-            ambient_occlusion_node.location = -400, 200
-            ambient_occlusion_node.image = bpy.data.images.load(ao_map_path)
-            ambient_occlusion_node.image.colorspace_settings.name = 'Non-Color'
-            node_tree.links.new(ambient_occlusion_node.outputs["Color"], principled_node.inputs["Ambient Occlusion"])
-            #'''
-            
-            '''
-            # TODO add thickness
-            # Add a texture node for the thickness map
-            thickness_map_node = nodes.new(type="ShaderNodeTexImage")
-            thickness_map_node.location = -400, -200
-            thickness_map_node.image = bpy.data.images.load(thickness_map_path)
-            thickness_map_node.image.colorspace_settings.name = 'Non-Color'
-            node_tree.links.new(thickness_map_node.outputs["Color"], principled_node.inputs["Transmission"])
-            #'''
-
-            # Set the subsurface properties
-            principled_node.inputs["Subsurface"].default_value = 0.001
-            principled_node.inputs["Subsurface Color"].default_value = (1, 0, 0, 1)
-
-            # Link the output of the Principled BSDF node to the material output
-            output_node = nodes.new(type="ShaderNodeOutputMaterial")
-            output_node.location = 400, 0
-            node_tree.links.new(principled_node.outputs["BSDF"], output_node.inputs["Surface"])
+        for obj in objects:
+            assign_material(obj, material)
 
-        else:
-            texture_name = context.window_manager.smpl_tool.texture
-
-            if (len(obj.data.materials) == 0) or (obj.data.materials[0] is None):
-                self.report({'WARNING'}, "Selected mesh has no material: %s" % obj.name)
-                return {'CANCELLED'}
-
-            # Find texture node
-            node_texture = None
-            for node in nodes:
-                if node.type == 'TEX_IMAGE':
-                    node_texture = node
-                    break
-
-            # Find shader node
-            node_shader = None
-            for node in nodes:
-                if node.type.startswith('BSDF'):
-                    node_shader = node
-                    break
-
-            if texture_name == 'NONE':
-                # Unlink texture node
-                if node_texture is not None:
-                    for link in node_texture.outputs[0].links:
-                        node_tree.links.remove(link)
-
-                    nodes.remove(node_texture)
-
-                    # 3D Viewport still shows previous texture when texture link is removed via script.
-                    # As a workaround we trigger desired viewport update by setting color value.
-                    node_shader.inputs[0].default_value = node_shader.inputs[0].default_value
-            else:
-                if node_texture is None:
-                    node_texture = nodes.new(type="ShaderNodeTexImage")
-
-                if (texture_name == 'UV_GRID') or (texture_name == 'COLOR_GRID'):
-                    if texture_name not in bpy.data.images:
-                        bpy.ops.image.new(name=texture_name, generated_type=texture_name)
-                    image = bpy.data.images[texture_name]
-                else:
-                    if texture_name not in bpy.data.images:
-                        texture_path = os.path.join(PATH, "data", texture_name)
-                        image = bpy.data.images.load(texture_path)
-                    else:
-                        image = bpy.data.images[texture_name]
-
-                node_texture.image = image
-
-                # Link texture node to shader node if not already linked
-                if len(node_texture.outputs[0].links) == 0:
-                    node_tree.links.new(node_texture.outputs[0], node_shader.inputs[0])
-
-        # Switch viewport shading to Material Preview to show texture
+        # Switch viewport shading to Material Preview to show texture, unless it already shows materials
         if bpy.context.space_data:
-            if bpy.context.space_data.type == 'VIEW_3D':
+            if (bpy.context.space_data.type == 'VIEW_3D') and (bpy.context.space_data.shading.type in ('WIREFRAME', 'SOLID')):
                 bpy.context.space_data.shading.type = 'MATERIAL'
 
         return {'FINISHED'}
@@ -482,58 +482,29 @@ class OP_MeasurementsToShape(bpy.types.Operator):
     bl_description = ("Calculate and set shape parameters for specified measurements")
     bl_options = {'REGISTER', 'UNDO'}
 
-    betas_regressor_female = None
-    betas_regressor_male = None
-    betas_regressor_neutral = None
-
     @classmethod
     def poll(cls, context):
         try:
             # Enable button only if mesh is active object
-            return ((context.object.type == 'MESH') and (context.object.parent.type == 'ARMATURE'))
+            return ((context.object.type == 'MESH') and (context.object.parent.type == 'ARMATURE') and has_shape_keys(context.object))
         except: return False
 
     def execute(self, context):
         obj = bpy.context.object
         bpy.ops.object.mode_set(mode='OBJECT')
 
-        if self.betas_regressor_female is None:
-            regressor_path = os.path.join(PATH, "data", "measurements_to_betas_female.json")
-            with open(regressor_path) as f:
-                data = json.load(f)
-                self.betas_regressor_female = (
-                    np.asarray(data["A"]).reshape(-1, 2), 
-                    np.asarray(data["B"]).reshape(-1, 1)
-                )
-
-        if self.betas_regressor_male is None:
-            regressor_path = os.path.join(PATH, "data", "measurements_to_betas_male.json")
-            with open(regressor_path) as f:
-                data = json.load(f)
-                self.betas_regressor_male = (
-                    np.asarray(data["A"]).reshape(-1, 2),
-                    np.asarray(data["B"]).reshape(-1, 1)
-                )
-
-        if self.betas_regressor_neutral is None:
-            regressor_path = os.path.join(PATH, "data", "measurements_to_betas_neutral.json")
-            with open(regressor_path) as f:
-                data = json.load(f)
-                self.betas_regressor_neutral = (
-                    np.asarray(data["A"]).reshape(-1, 2), 
-                    np.asarray(data["B"]).reshape(-1, 1)
-                )
-
         if "female" in obj.name.lower():
-            (A, B) = self.betas_regressor_female
+            gender = "female"
         elif "male" in obj.name.lower():
-            (A, B) = self.betas_regressor_male
+            gender = "male"
         elif "neutral" in obj.name.lower():
-            (A, B) = self.betas_regressor_neutral
+            gender = "neutral"
         else:
             self.report({"ERROR"}, f"Cannot derive gender from mesh object name: {obj.name}")
             return {"CANCELLED"}
 
+        (A, B) = load_measurements_to_betas(gender)
+
         # Calculate beta values from measurements
         height_cm = context.window_manager.smpl_tool.height
         weight_kg = context.window_manager.smpl_tool.weight
@@ -542,19 +513,8 @@ class OP_MeasurementsToShape(bpy.types.Operator):
         measurements = np.asarray([[height_cm], [v_root]])
         betas = A @ measurements + B
 
-        num_betas = betas.shape[0]
-        for i in range(num_betas):
-            name = f"Shape{i:03d}"
-            key_block = obj.data.shape_keys.key_blocks[name]
-            value = betas[i, 0]
-
-            # Adjust key block min/max range to value
-            if value < key_block.slider_min:
-                key_block.slider_min = value
-            elif value > key_block.slider_max:
-                key_block.slider_max = value
-
-            key_block.value = value
+        # Adjust key block min/max range to values
+        set_key_block_values(obj.data.shape_keys, "Shape", betas[:, 0], expand_slider_range=True)
 
         bpy.ops.object.update_joint_locations('EXEC_DEFAULT')
 
@@ -571,18 +531,15 @@ class OP_RandomBodyShape(bpy.types.Operator):
     def poll(cls, context):
         try:
             # Enable button only if mesh is active object
-            return context.object.type == 'MESH'
+            return ((context.object.type == 'MESH') and has_shape_keys(context.object))
         except: return False
 
     def execute(self, context):
         obj = bpy.context.object
         bpy.ops.object.mode_set(mode='OBJECT')
 
-        for i in range(0, 10):
-            key_name = f"Shape{'%0.3d' % i}"
-            key_block = obj.data.shape_keys.key_blocks.get(key_name)
-            beta = np.random.normal(0.0, 1.0) * .75 * context.window_manager.smpl_tool.random_body_mult
-            key_block.value = beta
+        betas = np.random.normal(0.0, 1.0, NUM_BODY_SHAPES) * .75 * context.window_manager.smpl_tool.random_body_mult
+        set_key_block_values(obj.data.shape_keys, "Shape", betas)
 
         bpy.ops.object.update_joint_locations('EXEC_DEFAULT')
 
@@ -604,18 +561,16 @@ class OP_RandomFaceShape(bpy.types.Operator):
     def poll(cls, context):
         try:
             # Enable button only if mesh is active object
-            return context.object.type == 'MESH'
+            return ((context.object.type == 'MESH') and has_shape_keys(context.object))
         except: return False
 
     def execute(self, context):
         obj = bpy.context.object
         bpy.ops.object.mode_set(mode='OBJECT')
 
-        for i in range(10,299):
-            key_name = f"Shape{'%0.3d' % i}"
-            key_block = obj.data.shape_keys.key_blocks.get(key_name)
-            beta = np.random.normal(0.0, 1.0) * .75 * context.window_manager.smpl_tool.random_face_mult
-            key_block.value = beta
+        num_face_shapes = num_key_blocks(obj.data.shape_keys, "Shape") - NUM_BODY_SHAPES
+        betas = np.random.normal(0.0, 1.0, num_face_shapes) * .75 * context.window_manager.smpl_tool.random_face_mult
+        set_key_block_values(obj.data.shape_keys, "Shape", betas, start=NUM_BODY_SHAPES)
 
         bpy.ops.object.update_joint_locations('EXEC_DEFAULT')
         
@@ -632,7 +587,7 @@ class OP_ResetBodyShape(bpy.types.Operator):
     def poll(cls, context):
         try:
             # Enable button only if mesh is active object
-            return context.object.type == 'MESH'
+            return ((context.object.type == 'MESH') and has_shape_keys(context.object))
         except: return False
 
     def execute(self, context):
@@ -660,10 +615,7 @@ class OP_ResetBodyShape(bpy.types.Operator):
             context.window_manager.smpl_tool.weight = 77.51340327590397
 
         # this is the step that manually 0's out the shape keys
-        for i in range(0,10):
-            key_name = f"Shape{'%0.3d' % i}"
-            key_block = obj.data.shape_keys.key_blocks.get(key_name)
-            key_block.value = 0
+        set_key_block_values(obj.data.shape_keys, "Shape", np.zeros(NUM_BODY_SHAPES))
 
         bpy.ops.object.update_joint_locations('EXEC_DEFAULT')
         context.window_manager.smpl_tool.alert = False
@@ -684,17 +636,15 @@ class OP_ResetFaceShape(bpy.types.Operator):
     def poll(cls, context):
         try:
             # Enable button only if mesh is active object
-            return context.object.type == 'MESH'
+            return ((context.object.type == 'MESH') and has_shape_keys(context.object))
         except: return False
 
     def execute(self, context):
         obj = bpy.context.object
         bpy.ops.object.mode_set(mode='OBJECT')
 
-        for i in range(10,299):
-            key_name = f"Shape{'%0.3d' % i}"
-            key_block = obj.data.shape_keys.key_blocks.get(key_name)
-            key_block.value = 0
+        num_face_shapes = num_key_blocks(obj.data.shape_keys, "Shape") - NUM_BODY_SHAPES
+        set_key_block_values(obj.data.shape_keys, "Shape", np.zeros(num_face_shapes), start=NUM_BODY_SHAPES)
 
         bpy.ops.object.update_joint_locations('EXEC_DEFAULT')
 
@@ -711,16 +661,15 @@ class OP_RandomExpressionShape(bpy.types.Operator):
     def poll(cls, context):
         try:
             # Enable button only if mesh is active object
-            return ((context.object.type == 'MESH') and (bpy.context.object['SMPL_version'] != "SMPLH"))
+            return ((context.object.type == 'MESH') and (bpy.context.object['SMPL_version'] != "SMPLH") and has_shape_keys(context.object))
         except: return False
 
     def execute(self, context):
         obj = bpy.context.object
         bpy.ops.object.mode_set(mode='OBJECT')
 
-        for key_block in obj.data.shape_keys.key_blocks:
-            if key_block.name.startswith('Exp'):
-                key_block.value = np.random.uniform(-1.5, 1.5)
+        num_expressions = num_key_blocks(obj.data.shape_keys, "Exp")
+        set_key_block_values(obj.data.shape_keys, "Exp", np.random.uniform(-1.5, 1.5, num_expressions))
 
         return {'FINISHED'}
 
@@ -735,16 +684,15 @@ class OP_ResetExpressionShape(bpy.types.Operator):
     def poll(cls, context):
         try:
             # Enable button only if mesh is active object
-            return ((context.object.type == 'MESH') and (bpy.context.object['SMPL_version'] != "SMPLH"))
+            return ((context.object.type == 'MESH') and (bpy.context.object['SMPL_version'] != "SMPLH") and has_shape_keys(context.object))
         except: return False
 
     def execute(self, context):
         obj = bpy.context.object
         bpy.ops.object.mode_set(mode='OBJECT')
 
-        for key_block in obj.data.shape_keys.key_blocks:
-            if key_block.name.startswith('Exp'):
-                key_block.value = 0.0
+        num_expressions = num_key_blocks(obj.data.shape_keys, "Exp")
+        set_key_block_values(obj.data.shape_keys, "Exp", np.zeros(num_expressions))
 
         return {'FINISHED'}
 
@@ -755,6 +703,16 @@ class OP_SnapToGroundPlane(bpy.types.Operator):
     bl_description = ("Snaps mesh to the XY ground plane")
     bl_options = {'REGISTER', 'UNDO'}
 
+    mode: EnumProperty(
+        name="Mode",
+        items=(
+            ("CURRENT", "Current frame", "Move the lowest vertex of the current frame onto the ground plane"),
+            ("CONSTANT", "Whole animation", "Move the avatar up or down once, so that its feet touch the ground plane at the lowest frame of the animation"),
+            ("PER_FRAME", "Every frame", "Keyframe the avatar height so that its feet touch the ground plane on every frame of the animation"),
+        ),
+        default="CURRENT",
+    )
+
     @classmethod
     def poll(cls, context):
         try:
@@ -772,16 +730,12 @@ class OP_SnapToGroundPlane(bpy.types.Operator):
         else:
             armature = obj.parent
 
-        # Get vertices with applied skin modifier in object coordinates
-        depsgraph = context.evaluated_depsgraph_get()
-        object_eval = obj.evaluated_get(depsgraph)
-        mesh_from_eval = object_eval.to_mesh()
+        if self.mode != 'CURRENT':
+            return self.snap_animation(context, obj, armature)
 
-        # Get vertices in world coordinates
-        matrix_world = obj.matrix_world
-        vertices_world = [matrix_world @ vertex.co for vertex in mesh_from_eval.vertices]
-        z_min = (min(vertices_world, key=lambda item: item.z)).z
-        object_eval.to_mesh_clear() # Remove temporary mesh
+        # Get vertices with applied skin modifier in world coordinates
+        vertices_world = evaluated_vertex_coordinates(obj, context.evaluated_depsgraph_get(), world=True)
+        z_min = vertices_world[:, 2].min()
 
         # Adjust height of armature so that lowest vertex is on ground plane.
         # Do not apply new armature location transform so that we are later able to show loaded poses at their desired height.
@@ -789,6 +743,27 @@ class OP_SnapToGroundPlane(bpy.types.Operator):
 
         return {'FINISHED'}
 
+    def snap_animation(self, context, obj, armature):
+        if (armature.animation_data is None) or (armature.animation_data.action is None):
+            self.report({"ERROR"}, "Avatar has no animation")
+            return {"CANCELLED"}
+
+        # Poses the sole vertices for all frames at once with the NumPy body model, see body_model.py
+        action = armature.animation_data.action
+        (frame_start, frame_end) = action.frame_range
+        frames = np.arange(int(frame_start), int(frame_end) + 1)
+
+        model = get_body_model(obj['SMPL_version'], obj['gender'])
+        heights = sole_heights(obj, armature, model, frames)
+
+        if self.mode == 'CONSTANT':
+            armature.location.z = armature.location.z - heights.min()
+        else:
+            write_fcurve(action, "location", 2, frames, armature.location.z - heights, group="Object Transforms")
+            context.scene.frame_set(context.scene.frame_current)
+
+        return {'FINISHED'}
+
 
 class OP_UpdateJointLocations(bpy.types.Operator):
     bl_idname = "object.update_joint_locations"
@@ -796,35 +771,15 @@ class OP_UpdateJointLocations(bpy.types.Operator):
     bl_description = ("You only need to click this button if you change the shape keys from the object data tab (not using the plugin)")
     bl_options = {'REGISTER', 'UNDO'}
 
-    j_regressor_female = {}
-    j_regressor_male = {}
-    j_regressor_neutral = {}
-
     @classmethod
     def poll(cls, context):
         try:
             # Enable button only if mesh is active object
-            return ((context.object.type == 'MESH') and (context.object.parent.type == 'ARMATURE'))
+            # Shared mesh avatars have no shape keys, their joints are set when the shape is baked
+            return ((context.object.type == 'MESH') and (context.object.parent.type == 'ARMATURE') and (context.object.data.shape_keys is not None))
         except Exception: 
             return False
 
-    def load_regressor(self, gender, betas, SMPL_version):
-        # TODO recreate the SUPR joint regressor so that it doesn't include the 100 expression shape keys.  There are two `if SMPL_version == 'supr'` that we will be able to get rid of as a result
-        if betas == 10:
-            suffix = ""
-        elif betas == 300:
-            suffix = "_300"
-        elif betas == 400:
-            suffix = "_400"
-        else:
-            print(f"ERROR: No betas-to-joints regressor for desired beta shapes [{betas}]")
-            return (None, None)
-
-        regressor_path = os.path.join(PATH, "data", f"{SMPL_version}_betas_to_joints_{gender}{suffix}.json")
-        with open(regressor_path) as f:
-            data = json.load(f)
-            return (np.asarray(data["betasJ_regr"]), np.asarray(data["template_J"]))
-
     def execute(self, context):
         obj = bpy.context.object
         bpy.ops.object.mode_set(mode='OBJECT')
@@ -837,46 +792,18 @@ class OP_UpdateJointLocations(bpy.types.Operator):
 
         gender = bpy.context.object['gender']
         joint_names = MODEL_JOINT_NAMES[SMPL_version].value
-        num_joints = len(joint_names)
-
-        # Get beta shapes
-        betas = []
-        for key_block in obj.data.shape_keys.key_blocks:
-            if key_block.name.startswith("Shape"):
-                if not key_block.mute:
-                    betas.append(key_block.value)
-                else: #if the value is unchecked in the gui, it's regarded as zero
-                    betas.append(0.0)
-        num_betas = len(betas)
-        betas = np.array(betas)
-
-        # "Cache regressor files"
-        # I think whoever wrote this thought they were caching everything, but they're really just doing it every time this is used, which is bad.
-        # TODO we need to actually cache all the files
-        self.j_regressor = { num_betas: None }
-        self.j_regressor[num_betas] = self.load_regressor(gender, num_betas, SMPL_version.lower())
-        (betas_to_joints, template_j) = self.j_regressor[num_betas]
-        joint_locations = betas_to_joints @ betas + template_j
-
-        # Set new bone joint locations
-        armature = obj.parent
-        bpy.context.view_layer.objects.active = armature
-        bpy.ops.object.mode_set(mode='EDIT')
-
-        for index in range(num_joints):
-            bone = armature.data.edit_bones[joint_names[index]]
-            setup_bone(bone, SMPL_version)
 
-            # Convert joint locations to Blender joint locations
-            joint_location = joint_locations[index]
+        # Get beta shapes, muted (unchecked in the gui) keys are regarded as zero
+        betas = betas_from_mesh(obj.data)
 
-            if SMPL_version in ['SMPLX', 'SUPR']:
-                bone_start = Vector((joint_location[0]*100, joint_location[1]*100, joint_location[2]*100))
-
-            bone.translate(bone_start)
+        # Regressors are cached for the whole session, see regressors.clear_regressor_cache().
+        # Only the regressor columns of the betas that changed since the last update of this object are applied.
+        joint_locations = regress_joint_locations(SMPL_version, gender, betas, cache_key=joint_cache_key(obj))
+        if joint_locations is None:
+            return {'CANCELLED'}
 
-        bpy.ops.object.mode_set(mode='OBJECT')
-        bpy.context.view_layer.objects.active = obj
+        # Set new bone joint locations
+        set_joint_locations(obj.parent, joint_names, joint_locations, SMPL_version)
 
         return {'FINISHED'}
 
@@ -891,61 +818,13 @@ class OP_CalculatePoseCorrectives(bpy.types.Operator):
     def poll(cls, context):
         try:
             # Enable button only if mesh is active object and parent is armature
-            return ( ((context.object.type == 'MESH') and (context.object.parent.type == 'ARMATURE')) or (context.object.type == 'ARMATURE'))
+            return ((((context.object.type == 'MESH') and (context.object.parent.type == 'ARMATURE')) or (context.object.type == 'ARMATURE')) and has_shape_keys(context.object))
         except: return False
 
-    # https://github.com/gulvarol/surreal/blob/master/datageneration/main_part1.py
-    # Computes rotation matrix through Rodrigues formula as in cv2.Rodrigues
-    def rodrigues_to_mat(self, rotvec):
-        theta = np.linalg.norm(rotvec)
-        r = (rotvec/theta).reshape(3, 1) if theta > 0. else rotvec
-        cost = np.cos(theta)
-        mat = np.asarray([[0, -r[2], r[1]],
-                        [r[2], 0, -r[0]],
-                        [-r[1], r[0], 0]], dtype=object)
-        return(cost*np.eye(3) + (1-cost)*r.dot(r.T) + np.sin(theta)*mat)
-    
-    def rodrigues_to_quat(self, rotvec):
-        theta = np.linalg.norm(rotvec)
-        r = (rotvec/theta).reshape(3, 1) if theta > 0. else rotvec
-        return(Quaternion(r, theta))
-
-    # https://github.com/gulvarol/surreal/blob/master/datageneration/main_part1.py
-    # Calculate weights of pose corrective blendshapes
-    # Input is pose of all 55 joints, output is weights for all joints except pelvis
-    def rodrigues_to_posecorrective_weight(self, context, pose):
-        SMPL_version = bpy.context.object['SMPL_version']
-        joint_names = MODEL_JOINT_NAMES[SMPL_version].value
-        num_joints = len(joint_names)
-        
-        if SMPL_version in ('SMPLX', 'SMPLH'):
-            rod_rots = np.asarray(pose).reshape(num_joints, 3)
-            mat_rots = [self.rodrigues_to_mat(rod_rot) for rod_rot in rod_rots]
-            bshapes = np.concatenate([(mat_rot - np.eye(3)).ravel() for mat_rot in mat_rots[1:]])
-            return(bshapes)
-
-        elif SMPL_version == 'SUPR':
-            rod_rots = np.asarray(pose).reshape(num_joints, 3)
-            quats = [self.rodrigues_to_quat(rod_rot) for rod_rot in rod_rots]
-            for q in quats:
-                qcopy = copy.deepcopy(q)
-                q.w = qcopy.x
-                q.x = qcopy.y
-                q.y = qcopy.z
-                q.z = qcopy.w - 1 # same as (1 - qcopy.w) * -1
-            bshapes = np.concatenate([quat for quat in quats[0:]])
-
-            return(bshapes)
-            
-        else:
-            return("error")
-
-
     def execute(self, context):
         obj = bpy.context.object
         SMPL_version = bpy.context.object['SMPL_version']
         joint_names = MODEL_JOINT_NAMES[SMPL_version].value
-        num_joints = len(joint_names)
 
         # Get armature pose in rodrigues representation
         if obj.type == 'ARMATURE':
@@ -954,27 +833,16 @@ class OP_CalculatePoseCorrectives(bpy.types.Operator):
         else:
             armature = obj.parent
 
-        pose = [0.0] * (num_joints * 3)
-
-        for index in range(num_joints):
-            joint_name = joint_names[index]
-            joint_pose = rodrigues_from_pose(armature, joint_name)
-            pose[index*3 + 0] = joint_pose[0]
-            pose[index*3 + 1] = joint_pose[1]
-            pose[index*3 + 2] = joint_pose[2]
+        pose = pose_from_armature(armature, joint_names)
 
-        poseweights = self.rodrigues_to_posecorrective_weight(context, pose)
-
-        # TODO for the time being, the SMPLX pose correctives only go to 0-206.  
-        # It should be 0-485, but we're not sure why the fingers aren't being written out of the blender-worker  
-        if SMPL_version in ['SMPLH', 'SMPLX']:
-            poseweights_to_use = poseweights[0:207]
-        else:
-            poseweights_to_use = poseweights
+        try:
+            poseweights = pose_corrective_weights(SMPL_version, pose, len(joint_names))
+        except ValueError as error:
+            self.report({"ERROR"}, str(error))
+            return {"CANCELLED"}
 
         # Set weights for pose corrective shape keys
-        for index, weight in enumerate(poseweights_to_use):
-            obj.data.shape_keys.key_blocks["Pose%03d" % index].value = weight
+        set_key_block_values(obj.data.shape_keys, "Pose", poseweights)
 
         return {'FINISHED'}
 
@@ -989,29 +857,27 @@ class OP_CalculatePoseCorrectivesForSequence(bpy.types.Operator):
     def poll(cls, context):
         try:
             # Enable button only if mesh is active object and parent is armature
-            return ( ((context.object.type == 'MESH') and (context.object.parent.type == 'ARMATURE')) or (context.object.type == 'ARMATURE'))
+            return ((((context.object.type == 'MESH') and (context.object.parent.type == 'ARMATURE')) or (context.object.type == 'ARMATURE')) and has_shape_keys(context.object))
         except: return False
     
     def execute(self, context):
-         # Get the start and end frames from the scene's render settings
+        # Get the start and end frames from the scene's render settings
         start_frame = bpy.context.scene.frame_start
         end_frame = bpy.context.scene.frame_end
 
-        # Get the object you want to animate
         obj = bpy.context.object
+        if obj.type == 'ARMATURE':
+            armature = obj
+            obj = bpy.context.object.children[0]
+        else:
+            armature = obj.parent
 
-        # Iterate over each frame
-        for frame in range(start_frame, end_frame + 1):
-            # Set the current frame
-            bpy.context.scene.frame_set(frame)
-            
-            # Update pose shapes
-            bpy.ops.object.set_pose_correctives('EXEC_DEFAULT')
-            
-            # Insert a keyframe
-            obj.keyframe_insert(data_path="location", frame=frame)
-            obj.keyframe_insert(data_path="rotation_euler", frame=frame)
-            obj.keyframe_insert(data_path="scale", frame=frame)
+        # Read all bone rotations once, compute the weights for the whole range and keyframe the Pose### shape keys
+        try:
+            bake_pose_correctives(obj, armature, range(start_frame, end_frame + 1))
+        except ValueError as error:
+            self.report({"ERROR"}, str(error))
+            return {"CANCELLED"}
 
         return {"FINISHED"}
 
@@ -1026,7 +892,7 @@ class OP_ZeroOutPoseCorrectives(bpy.types.Operator):
     def poll(cls, context):
         try:
             # Enable button only if mesh is active object and parent is armature
-            return ( ((context.object.type == 'MESH') and (context.object.parent.type == 'ARMATURE')) or (context.object.type == 'ARMATURE'))
+            return ((((context.object.type == 'MESH') and (context.object.parent.type == 'ARMATURE')) or (context.object.type == 'ARMATURE')) and has_shape_keys(context.object))
         except: return False
 
     def execute(self, context):
@@ -1035,9 +901,8 @@ class OP_ZeroOutPoseCorrectives(bpy.types.Operator):
         if obj.type == 'ARMATURE':
             obj = bpy.context.object.children[0]
 
-        for key_block in obj.data.shape_keys.key_blocks:
-            if key_block.name.startswith("Pose"):
-                key_block.value = 0.0
+        num_pose_correctives = num_key_blocks(obj.data.shape_keys, "Pose")
+        set_key_block_values(obj.data.shape_keys, "Pose", np.zeros(num_pose_correctives))
 
         return {'FINISHED'}
 
@@ -1120,7 +985,6 @@ class OP_WritePoseToConsole(bpy.types.Operator):
         obj = bpy.context.object
         SMPL_version = bpy.context.object['SMPL_version']
         joint_names = MODEL_JOINT_NAMES[SMPL_version].value
-        num_joints = len(joint_names)
 
         if obj.type == 'MESH':
             armature = obj.parent
@@ -1128,14 +992,7 @@ class OP_WritePoseToConsole(bpy.types.Operator):
             armature = obj
 
         # Get armature pose in rodrigues representation
-        pose = [0.0] * (num_joints * 3)
-
-        for index in range(num_joints):
-            joint_name = joint_names[index]
-            joint_pose = rodrigues_from_pose(armature, joint_name)
-            pose[index*3 + 0] = joint_pose[0]
-            pose[index*3 + 1] = joint_pose[1]
-            pose[index*3 + 2] = joint_pose[2]
+        pose = pose_from_armature(armature, joint_names).ravel().tolist()
 
         print("\npose = ")
         pose_by_joint = [pose[i:i+3] for i in range(0,len(pose),3)]
@@ -1170,7 +1027,6 @@ class OP_WritePoseToJSON(bpy.types.Operator, ExportHelper):
         obj = bpy.context.object
         SMPL_version = bpy.context.object['SMPL_version']
         joint_names = MODEL_JOINT_NAMES[SMPL_version].value
-        num_joints = len(joint_names)
 
         if obj.type == 'MESH':
             armature = obj.parent
@@ -1178,14 +1034,7 @@ class OP_WritePoseToJSON(bpy.types.Operator, ExportHelper):
             armature = obj
 
         # Get armature pose in rodrigues representation
-        pose = [0.0] * (num_joints * 3)
-
-        for index in range(num_joints):
-            joint_name = joint_names[index]
-            joint_pose = rodrigues_from_pose(armature, joint_name)
-            pose[index*3 + 0] = joint_pose[0]
-            pose[index*3 + 1] = joint_pose[1]
-            pose[index*3 + 2] = joint_pose[2]
+        pose = pose_from_armature(armature, joint_names).ravel().tolist()
 
         pose_data = {
             "pose": pose,
@@ -1227,8 +1076,9 @@ class OP_ResetPose(bpy.types.Operator):
                 bone.rotation_mode = 'QUATERNION'
             bone.rotation_quaternion = Quaternion()
 
-        # Reset corrective pose shapes
-        bpy.ops.object.zero_out_pose_correctives('EXEC_DEFAULT')
+        # Reset corrective pose shapes, shared mesh avatars have none
+        if has_shape_keys(obj):
+            bpy.ops.object.zero_out_pose_correctives('EXEC_DEFAULT')
 
         return {'FINISHED'}
 
@@ -1428,23 +1278,25 @@ class OP_LoadPose(bpy.types.Operator, ImportHelper):
             context.window_manager.smpl_tool.hand_pose = self.hand_pose
             bpy.ops.object.set_hand_pose('EXEC_DEFAULT')
 
+        # Shared mesh avatars have no shape keys for pose correctives and expressions
+        shape_keys = has_shape_keys(obj)
+
         # Activate corrective poseshapes
-        bpy.ops.object.set_pose_correctives('EXEC_DEFAULT')
+        if shape_keys:
+            bpy.ops.object.set_pose_correctives('EXEC_DEFAULT')
 
         # Set face expression
         if extension == '.pkl':
             set_pose_from_rodrigues(armature, "jaw", jaw_pose, frame=bpy.data.scenes[0].frame_current)
 
-            for index, exp in enumerate(expression):
-                key_block_name = f"Exp{index:03}"
-
-                if key_block_name in obj.data.shape_keys.key_blocks:
-                    obj.data.shape_keys.key_blocks[key_block_name].value = exp
-                else:
-                    print(f"ERROR: No key block for: {key_block_name}")
+            if shape_keys:
+                num_set = set_key_block_values(obj.data.shape_keys, "Exp", expression)
+                if num_set < len(expression):
+                    print(f"ERROR: No key blocks for: Exp{num_set:03} to Exp{len(expression) - 1:03}")
 
-        bpy.ops.object.set_pose_correctives('EXEC_DEFAULT')
-        key_all_pose_correctives(obj=obj, index=bpy.data.scenes[0].frame_current)
+        if shape_keys:
+            bpy.ops.object.set_pose_correctives('EXEC_DEFAULT')
+            key_all_pose_correctives(obj=obj, index=bpy.data.scenes[0].frame_current)
 
         correct_for_anim_format(self.anim_format, armature)
         bpy.ops.object.snap_to_ground_plane('EXEC_DEFAULT')
@@ -1465,7 +1317,7 @@ class OP_SetExpressionPreset(bpy.types.Operator):
     def poll(cls, context):
         try:
             # Enable button only if mesh is active object
-            return ((context.object.type == 'MESH') and (bpy.context.object['SMPL_version'] != "SMPLH"))
+            return ((context.object.type == 'MESH') and (bpy.context.object['SMPL_version'] != "SMPLH") and has_shape_keys(context.object))
         except: return False
 
     def execute(self, context):
@@ -1507,11 +1359,7 @@ class OP_SetExpressionPreset(bpy.types.Operator):
             self.report({"WARNING"}, f"Unknown preset: {self.preset}")
             return {"CANCELLED"}
 
-        for i, value in enumerate(preset_values):
-            key_name = f"Exp{i:03}"
-            key_block = obj.data.shape_keys.key_blocks.get(key_name)
-            if key_block:
-                key_block.value = value
+        set_key_block_values(obj.data.shape_keys, "Exp", preset_values)
 
         return {"FINISHED"}
 
@@ -1585,6 +1433,148 @@ class OP_FixBlendShapeRanges(bpy.types.Operator):
         return {'FINISHED'}
 
 
+class OP_ExportAvatar(bpy.types.Operator, ExportHelper):
+    bl_idname = "object.export_avatar"
+    bl_label = "Export Avatar"
+    bl_description = ("Export the selected avatar and its animation with the selected shape keys")
+    bl_options = {'REGISTER'}
+
+    # ExportHelper mixin class uses this
+    filename_ext = ".fbx"
+
+    filter_glob: StringProperty(
+        default="*.fbx;*.obj",
+        options={'HIDDEN'}
+    )
+
+    export_format: EnumProperty(
+        name="Format",
+        items=[
+            (EXPORT_TYPE.FBX.value, "FBX", ""),
+            (EXPORT_TYPE.OBJ.value, "OBJ", "Mesh in the current pose, without armature and animation"),
+        ]
+    )
+
+    profile: EnumProperty(
+        name="Profile",
+        description="FBX exporter settings for the target application",
+        items=[
+            ("DEFAULT", "Default", ""),
+            ("UNITY", "Unity", ""),
+            ("UNREAL", "Unreal", ""),
+        ]
+    )
+
+    strip_unused: BoolProperty(
+        name="Strip Unused Shape Keys",
+        description="Do not export shape keys which are zero or muted and not animated",
+        default=True
+    )
+
+    bake_animation: BoolProperty(
+        name="Bake Animation",
+        description="Export the animation of the scene frame range",
+        default=True
+    )
+
+    bake_step: FloatProperty(
+        name="Sampling Rate",
+        description="How often to evaluate the animation, in frames",
+        default=1.0,
+        min=0.01,
+        max=100.0
+    )
+
+    simplify: FloatProperty(
+        name="Simplify",
+        description="How much to simplify the baked animation, 0 keeps every sampled keyframe",
+        default=1.0,
+        min=0.0,
+        max=100.0
+    )
+
+    frames_per_file: IntProperty(
+        name="Frames Per File",
+        description="Split long animations into files with at most this many frames. 0 exports a single file",
+        default=0,
+        min=0
+    )
+
+    @classmethod
+    def poll(cls, context):
+        try:
+            # Enable button only if an avatar mesh is active object in Object Mode
+            return ((context.object.type == 'MESH') and (context.object.parent.type == 'ARMATURE') and (context.object.mode == 'OBJECT'))
+        except: return False
+
+    def execute(self, context):
+        obj = bpy.context.object
+        filepath = os.path.splitext(self.filepath)[0] + "." + self.export_format
+        shape_keys = context.window_manager.smpl_tool.export_setting_shape_keys
+
+        paths = export_avatar(
+            obj,
+            filepath,
+            export_type=self.export_format,
+            shape_keys=shape_keys,
+            strip_unused=self.strip_unused,
+            profile=self.profile,
+            bake_animation=self.bake_animation,
+            bake_step=self.bake_step,
+            simplify=self.simplify,
+            frames_per_file=self.frames_per_file,
+        )
+
+        self.report({'INFO'}, f"Exported {len(paths)} file(s): {filepath}")
+        return {'FINISHED'}
+
+
+class OP_ExportGLB(bpy.types.Operator, ExportHelper):
+    bl_idname = "object.export_glb"
+    bl_label = "Export Avatar .glb"
+    bl_description = ("Export the selected avatar, its shape keys and animation to a binary glTF file")
+    bl_options = {'REGISTER'}
+
+    # ExportHelper mixin class uses this
+    filename_ext = ".glb"
+
+    filter_glob: StringProperty(
+        default="*.glb",
+        options={'HIDDEN'}
+    )
+
+    strip_unused: BoolProperty(
+        name="Strip Unused Shape Keys",
+        description="Do not export shape keys which are zero or muted and not animated",
+        default=True
+    )
+
+    animation: BoolProperty(
+        name="Animation",
+        description="Export the animation of the scene frame range",
+        default=True
+    )
+
+    @classmethod
+    def poll(cls, context):
+        try:
+            # Enable button only if an avatar mesh is active object in Object Mode
+            return ((context.object.type == 'MESH') and (context.object.parent.type == 'ARMATURE') and (context.object.mode == 'OBJECT'))
+        except: return False
+
+    def execute(self, context):
+        obj = bpy.context.object
+        shape_keys = context.window_manager.smpl_tool.export_setting_shape_keys
+
+        # Skinning weights come from the packed body model instead of reading all vertex groups
+        model = get_body_model(obj['SMPL_version'], obj['gender'])
+
+        export_glb(obj, self.filepath, shape_keys=shape_keys, strip_unused=self.strip_unused, animation=self.animation, model=model)
+
+        self.report({'INFO'}, f"Exported {self.filepath}")
+        return {'FINISHED'}
+
+
 OPERATORS = [
     OP_LoadAvatar,
     OP_CreateAvatar,
@@ -1610,4 +1600,6 @@ OPERATORS = [
     OP_ModifyMetadata,
     OP_ReadMetadata,
     OP_FixBlendShapeRanges,
+    OP_ExportAvatar,
+    OP_ExportGLB,
 ]
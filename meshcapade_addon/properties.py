@@ -8,6 +8,13 @@ from bpy.props import (
 from bpy.types import (
     PropertyGroup,
 )
+from .materials import (
+    set_texture_resolution,
+)
+
+def TextureResolution(self, context):
+    set_texture_resolution(int(self.texture_resolution))
+
 
 def MeasurementsToShape(self, context):
     bpy.ops.object.measurements_to_shape('EXEC_DEFAULT')
@@ -48,6 +55,18 @@ class PG_SMPLProperties(PropertyGroup):
         ]
     )
 
+    texture_resolution: EnumProperty(
+        name="Resolution",
+        description="Resolution of the texture maps in the viewport. Final renders always use the full resolution",
+        items=[
+            ("1", "Full", "Full resolution textures"),
+            ("2", "1/2", "Half resolution proxy textures"),
+            ("4", "1/4", "Quarter resolution proxy textures"),
+            ("8", "1/8", "Eighth resolution proxy textures"),
+        ],
+        update=TextureResolution,
+    )
+
     hand_pose: EnumProperty(
         name="Hands",
         description="hand pose",
@@ -0,0 +1,132 @@
+import os
+import json
+import numpy as np
+
+from .globals import (
+    PATH,
+)
+
+# betas-to-joints regressor file suffix for each number of shape components
+BETAS_TO_JOINTS_SUFFIXES = {
+    10: "",
+    300: "_300",
+    400: "_400",
+}
+
+# Process-wide cache of parsed regressors, keyed by (SMPL_version, gender, num_betas).
+# Joint locations are updated on every shape key change, so the files must only be read once.
+_betas_to_joints_cache = {}
+
+# measurements-to-betas regressors, keyed by gender
+_measurements_to_betas_cache = {}
+
+# Last (model, betas, joint locations, number of incremental updates) per avatar, see regress_joint_locations()
+_joint_locations_cache = {}
+
+# Incremental updates accumulate floating point error, so every this many updates the joints are regressed from scratch
+FULL_REGRESSION_INTERVAL = 100
+
+
+def load_regressor_arrays(name, keys):
+    # Prefers the binary files written by build/convert_regressors.py and falls back to the .json file.
+    # <name>_<key>.npy files are memory-mapped read-only so only the pages that are used get loaded.
+    data_path = os.path.join(PATH, "data")
+
+    npy_paths = [os.path.join(data_path, f"{name}_{key}.npy") for key in keys]
+    if all(os.path.exists(path) for path in npy_paths):
+        return tuple(np.load(path, mmap_mode='r') for path in npy_paths)
+
+    npz_path = os.path.join(data_path, f"{name}.npz")
+    if os.path.exists(npz_path):
+        with np.load(npz_path) as data:
+            return tuple(data[key] for key in keys)
+
+    with open(os.path.join(data_path, f"{name}.json")) as f:
+        data = json.load(f)
+        return tuple(np.asarray(data[key]) for key in keys)
+
+
+def load_betas_to_joints(SMPL_version, gender, num_betas):
+    # TODO recreate the SUPR joint regressor so that it doesn't include the 100 expression shape keys.  There are two `if SMPL_version == 'supr'` that we will be able to get rid of as a result
+    SMPL_version = SMPL_version.lower()
+    key = (SMPL_version, gender, num_betas)
+
+    if key not in _betas_to_joints_cache:
+        suffix = BETAS_TO_JOINTS_SUFFIXES.get(num_betas)
+        if suffix is None:
+            print(f"ERROR: No betas-to-joints regressor for desired beta shapes [{num_betas}]")
+            return (None, None)
+
+        _betas_to_joints_cache[key] = load_regressor_arrays(
+            f"{SMPL_version}_betas_to_joints_{gender}{suffix}",
+            ("betasJ_regr", "template_J"),
+        )
+
+    return _betas_to_joints_cache[key]
+
+
+def regress_joint_locations(SMPL_version, gender, betas, cache_key=None):
+    # Returns the (num_joints, 3) joint locations for the betas, or None if there is no regressor.
+    # With a cache_key (see scheduler.joint_cache_key()) the last result is kept, and the next call with the same key only
+    # applies the regressor columns of the betas that changed, so changing one of 400 betas costs one column.
+    betas = np.asarray(betas, dtype=np.float64)
+    (betas_to_joints, template_j) = load_betas_to_joints(SMPL_version, gender, len(betas))
+    if betas_to_joints is None:
+        return None
+
+    model = (SMPL_version.lower(), gender)
+    cached = _joint_locations_cache.get(cache_key)
+    if (cached is not None) and (cached[0] == model) and (cached[1].shape == betas.shape) and (cached[3] < FULL_REGRESSION_INTERVAL):
+        (_, last_betas, last_joints, num_updates) = cached
+        changed = np.flatnonzero(betas != last_betas)
+        joint_locations = last_joints + betas_to_joints[..., changed] @ (betas[changed] - last_betas[changed])
+        num_updates += 1
+    else:
+        joint_locations = betas_to_joints @ betas + template_j
+        num_updates = 0
+
+    if cache_key is not None:
+        _joint_locations_cache[cache_key] = (model, betas.copy(), joint_locations, num_updates)
+
+    return joint_locations
+
+
+def prune_joint_locations_cache(live_keys):
+    # Drops the cached joint locations of all keys not in live_keys, e.g. of deleted objects
+    for key in list(_joint_locations_cache):
+        if key not in live_keys:
+            del _joint_locations_cache[key]
+
+
+def load_measurements_to_betas(gender):
+    # Returns (A, B) so that betas = A @ [[height_cm], [cube root of weight_kg]] + B
+    if gender not in _measurements_to_betas_cache:
+        (A, B) = load_regressor_arrays(f"measurements_to_betas_{gender}", ("A", "B"))
+        _measurements_to_betas_cache[gender] = (A.reshape(-1, 2), B.reshape(-1, 1))
+
+    return _measurements_to_betas_cache[gender]
+
+
+def clear_regressor_cache(SMPL_version=None, gender=None):
+    # Drops cached regressors so that they are read from disk again on next use.
+    # Without arguments everything is dropped, otherwise only the matching version and/or gender.
+    for key in list(_betas_to_joints_cache):
+        if (SMPL_version is not None) and (key[0] != SMPL_version.lower()):
+            continue
+        if (gender is not None) and (key[1] != gender):
+            continue
+        del _betas_to_joints_cache[key]
+
+    # Cached joint locations were computed with the dropped regressors
+    for key in list(_joint_locations_cache):
+        model = _joint_locations_cache[key][0]
+        if (SMPL_version is not None) and (model[0] != SMPL_version.lower()):
+            continue
+        if (gender is not None) and (model[1] != gender):
+            continue
+        del _joint_locations_cache[key]
+
+    if SMPL_version is None:
+        for key in list(_measurements_to_betas_cache):
+            if (gender is None) or (key == gender):
+                del _measurements_to_betas_cache[key]
@@ -0,0 +1,160 @@
+# Batched rotation conversions for SMPL family poses.
+#
+# Pure NumPy, no bpy or mathutils, so the math can be tested and benchmarked outside of Blender.
+# All functions work on arrays with arbitrary leading dimensions, e.g. (num_frames, num_joints, 3).
+# Quaternions are stored in Blender's (w, x, y, z) order.
+import numpy as np
+
+# Below this angle [rad] the trigonometric terms are replaced by their Taylor expansion
+SMALL_ANGLE = 1e-6
+
+
+def rodrigues_to_quat(rodrigues):
+    # (..., 3) rodrigues (axis-angle) vectors -> (..., 4) unit quaternions
+    rodrigues = np.asarray(rodrigues, dtype=np.float64)
+    theta = np.linalg.norm(rodrigues, axis=-1, keepdims=True)
+    small = theta < SMALL_ANGLE
+
+    # sin(theta/2) / theta, which tends to 1/2 for theta -> 0
+    safe_theta = np.where(small, 1.0, theta)
+    scale = np.where(small, 0.5 - theta**2 / 48.0, np.sin(safe_theta / 2.0) / safe_theta)
+
+    quat = np.empty(rodrigues.shape[:-1] + (4,))
+    quat[..., :1] = np.cos(theta / 2.0)
+    quat[..., 1:] = rodrigues * scale
+    return quat
+
+
+def quat_to_rodrigues(quat):
+    # (..., 4) quaternions -> (..., 3) rodrigues vectors
+    # Like mathutils Quaternion.to_axis_angle() the angle is in [0, 2*pi], so the input quaternion sign is preserved.
+    quat = np.asarray(quat, dtype=np.float64)
+    quat = quat / np.linalg.norm(quat, axis=-1, keepdims=True)
+    w = quat[..., :1]
+    xyz = quat[..., 1:]
+
+    sin_half = np.linalg.norm(xyz, axis=-1, keepdims=True)
+    small = sin_half < SMALL_ANGLE
+
+    # angle / sin(angle/2), which tends to 2/w for angle -> 0
+    safe_sin_half = np.where(small, 1.0, sin_half)
+    scale = np.where(small, 2.0 / np.where(w == 0.0, 1.0, w), 2.0 * np.arctan2(sin_half, w) / safe_sin_half)
+    return xyz * scale
+
+
+def rodrigues_to_mat(rodrigues):
+    # (..., 3) rodrigues vectors -> (..., 3, 3) rotation matrices, equivalent to cv2.Rodrigues
+    rodrigues = np.asarray(rodrigues, dtype=np.float64)
+    theta = np.linalg.norm(rodrigues, axis=-1)[..., None, None]
+    small = theta < SMALL_ANGLE
+
+    # R = I + A*K + B*K^2 with K the cross product matrix of the unnormalized rotation vector,
+    # A = sin(theta)/theta and B = (1 - cos(theta))/theta^2
+    safe_theta = np.where(small, 1.0, theta)
+    a = np.where(small, 1.0 - theta**2 / 6.0, np.sin(safe_theta) / safe_theta)
+    b = np.where(small, 0.5 - theta**2 / 24.0, (1.0 - np.cos(safe_theta)) / safe_theta**2)
+
+    x = rodrigues[..., 0]
+    y = rodrigues[..., 1]
+    z = rodrigues[..., 2]
+    zeros = np.zeros_like(x)
+    k = np.stack([
+        np.stack([zeros, -z, y], axis=-1),
+        np.stack([z, zeros, -x], axis=-1),
+        np.stack([-y, x, zeros], axis=-1),
+    ], axis=-2)
+
+    return np.eye(3) + a * k + b * (k @ k)
+
+
+def euler_to_mat(euler, order='XYZ'):
+    # (..., 3) euler angles in x, y, z order -> (..., 3, 3) rotation matrices.
+    # order is the Blender rotation mode, e.g. 'XYZ' rotates around X first and Z last.
+    euler = np.asarray(euler, dtype=np.float64)
+    mats = {}
+    for (axis, (i, j)) in zip("XYZ", ((1, 2), (2, 0), (0, 1))):
+        angle = euler[..., "XYZ".index(axis)]
+        (c, s) = (np.cos(angle), np.sin(angle))
+        mat = np.zeros(euler.shape[:-1] + (3, 3))
+        mat[..., "XYZ".index(axis), "XYZ".index(axis)] = 1.0
+        mat[..., i, i] = c
+        mat[..., i, j] = -s
+        mat[..., j, i] = s
+        mat[..., j, j] = c
+        mats[axis] = mat
+
+    return mats[order[2]] @ mats[order[1]] @ mats[order[0]]
+
+
+def quat_to_mat(quat):
+    # (..., 4) quaternions -> (..., 3, 3) rotation matrices
+    quat = np.asarray(quat, dtype=np.float64)
+    quat = quat / np.linalg.norm(quat, axis=-1, keepdims=True)
+    w, x, y, z = np.moveaxis(quat, -1, 0)
+
+    return np.stack([
+        np.stack([1 - 2*(y*y + z*z), 2*(x*y - w*z), 2*(x*z + w*y)], axis=-1),
+        np.stack([2*(x*y + w*z), 1 - 2*(x*x + z*z), 2*(y*z - w*x)], axis=-1),
+        np.stack([2*(x*z - w*y), 2*(y*z + w*x), 1 - 2*(x*x + y*y)], axis=-1),
+    ], axis=-2)
+
+
+def mat_to_quat(mat):
+    # (..., 3, 3) rotation matrices -> (..., 4) unit quaternions with w >= 0
+    mat = np.asarray(mat, dtype=np.float64)
+    m00 = mat[..., 0, 0]
+    m11 = mat[..., 1, 1]
+    m22 = mat[..., 2, 2]
+
+    # Shepperd's method: compute all four candidates and keep the numerically best conditioned one
+    candidates = np.stack([
+        np.stack([1 + m00 + m11 + m22, mat[..., 2, 1] - mat[..., 1, 2], mat[..., 0, 2] - mat[..., 2, 0], mat[..., 1, 0] - mat[..., 0, 1]], axis=-1),
+        np.stack([mat[..., 2, 1] - mat[..., 1, 2], 1 + m00 - m11 - m22, mat[..., 0, 1] + mat[..., 1, 0], mat[..., 0, 2] + mat[..., 2, 0]], axis=-1),
+        np.stack([mat[..., 0, 2] - mat[..., 2, 0], mat[..., 0, 1] + mat[..., 1, 0], 1 - m00 + m11 - m22, mat[..., 1, 2] + mat[..., 2, 1]], axis=-1),
+        np.stack([mat[..., 1, 0] - mat[..., 0, 1], mat[..., 0, 2] + mat[..., 2, 0], mat[..., 1, 2] + mat[..., 2, 1], 1 - m00 - m11 + m22], axis=-1),
+    ], axis=-2)
+
+    best = np.argmax(np.stack([m00 + m11 + m22, m00, m11, m22], axis=-1), axis=-1)
+    quat = np.take_along_axis(candidates, best[..., None, None], axis=-2)[..., 0, :]
+    quat = quat / np.linalg.norm(quat, axis=-1, keepdims=True)
+    return np.where(quat[..., :1] < 0.0, -quat, quat)
+
+
+def mat_to_rodrigues(mat):
+    # (..., 3, 3) rotation matrices -> (..., 3) rodrigues vectors with angle in [0, pi]
+    return quat_to_rodrigues(mat_to_quat(mat))
+
+
+def quat_slerp(quat0, quat1, t):
+    # Spherical linear interpolation between (..., 4) quaternions along the shortest path, t: (..., 1) in [0, 1]
+    quat0 = np.asarray(quat0, dtype=np.float64)
+    quat1 = np.asarray(quat1, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)
+
+    dot = np.sum(quat0 * quat1, axis=-1, keepdims=True)
+    quat1 = np.where(dot < 0.0, -quat1, quat1)
+    dot = np.abs(dot)
+
+    theta = np.arccos(np.clip(dot, -1.0, 1.0))
+    sin_theta = np.sin(theta)
+    small = sin_theta < SMALL_ANGLE
+
+    # Fall back to normalized linear interpolation for (almost) identical quaternions
+    safe_sin_theta = np.where(small, 1.0, sin_theta)
+    weight0 = np.where(small, 1.0 - t, np.sin((1.0 - t) * theta) / safe_sin_theta)
+    weight1 = np.where(small, t, np.sin(t * theta) / safe_sin_theta)
+
+    quat = weight0 * quat0 + weight1 * quat1
+    return quat / np.linalg.norm(quat, axis=-1, keepdims=True)
+
+
+def quat_continuous(quat, axis=0):
+    # Flips quaternion signs along the given (time) axis so that consecutive quaternions lie in the
+    # same hemisphere. Both signs describe the same rotation, but componentwise interpolation between
+    # keyframes of opposite sign takes the long way around.
+    quat = np.array(quat, dtype=np.float64)
+    quat = np.moveaxis(quat, axis, 0)
+    dot = np.sum(quat[1:] * quat[:-1], axis=-1, keepdims=True)
+    flips = np.cumsum(dot < 0.0, axis=0) % 2
+    quat[1:] = np.where(flips == 1, -quat[1:], quat[1:])
+    return np.moveaxis(quat, 0, axis)
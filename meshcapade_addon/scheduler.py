@@ -0,0 +1,135 @@
+# Coalesced joint location updates for shape key changes.
+#
+# The ShapeKey msgbus subscription fires once per changed shape key property, so a script that sets 300 betas
+# would rebuild the armature 300 times. Instead, changed meshes are only marked dirty and the joint locations
+# of every dirty mesh are updated once on the next timer tick. Meshes whose bones already are at the joint
+# locations of their betas (e.g. after expression or pose corrective changes) are skipped. This compares with
+# the armature itself instead of remembering the last update, which would be wrong after undo.
+import bpy
+from bpy.app.handlers import persistent
+from contextlib import contextmanager
+import uuid
+
+from .blender import (
+    betas_from_mesh,
+    moved_joints,
+)
+from .globals import (
+    MODEL_JOINT_NAMES,
+)
+from .regressors import (
+    prune_joint_locations_cache,
+    regress_joint_locations,
+)
+
+# Custom property with the key of an avatar mesh in the joint locations cache, see joint_cache_key()
+JOINT_CACHE_KEY_PROPERTY = "smpl_joint_cache_key"
+
+# Seconds until the next attempt while updates are suspended or the user is not in object mode
+RETRY_INTERVAL = 0.25
+
+# Names of the meshes that need a joint update. Names instead of references, which become invalid on undo.
+_dirty_objects = set()
+
+_suspend_depth = 0
+
+
+def mark_dirty(obj):
+    _dirty_objects.add(obj.name)
+    if not bpy.app.timers.is_registered(update_dirty_objects):
+        bpy.app.timers.register(update_dirty_objects, first_interval=0.0)
+
+
+def joint_cache_key(obj):
+    # Key of the object in the joint locations cache of regressors.regress_joint_locations(). Unlike the name
+    # it survives renames and is not reused by another object after deleting this one. Duplicates share the
+    # key, which is harmless since every cache entry stores the betas it was regressed with.
+    if JOINT_CACHE_KEY_PROPERTY not in obj:
+        obj[JOINT_CACHE_KEY_PROPERTY] = uuid.uuid4().hex
+    return obj[JOINT_CACHE_KEY_PROPERTY]
+
+
+def prune_joint_caches():
+    # Drops the cached joint locations of deleted objects
+    prune_joint_locations_cache({obj[JOINT_CACHE_KEY_PROPERTY] for obj in bpy.data.objects if JOINT_CACHE_KEY_PROPERTY in obj})
+
+
+def needs_joint_update(obj):
+    # Regressing the joints only applies the changed regressor columns, see regressors.regress_joint_locations(),
+    # so this is cheap compared to the edit mode round trip of the update it avoids
+    SMPL_version = obj.get("SMPL_version")
+    if SMPL_version not in ('SMPLX', 'SUPR'):
+        return False
+
+    joint_locations = regress_joint_locations(SMPL_version, obj.get("gender"), betas_from_mesh(obj.data), cache_key=joint_cache_key(obj))
+    if joint_locations is None:
+        return False
+
+    (moved, _, _) = moved_joints(obj.parent, MODEL_JOINT_NAMES[SMPL_version].value, joint_locations)
+    return bool(moved.any())
+
+
+def update_dirty_objects():
+    # Timer callback. Returns the seconds until it wants to be called again, or None when done.
+    if (_suspend_depth > 0) or (bpy.context.mode != 'OBJECT'):
+        return RETRY_INTERVAL
+
+    view_layer = bpy.context.view_layer
+    previous_active = view_layer.objects.active
+
+    names = sorted(_dirty_objects)
+    _dirty_objects.clear()
+    for name in names:
+        obj = bpy.data.objects.get(name)
+        if (obj is None) or (obj.type != 'MESH') or (obj.data.shape_keys is None) or (name not in view_layer.objects):
+            continue
+        if (obj.parent is None) or (obj.parent.type != 'ARMATURE') or (not needs_joint_update(obj)):
+            continue
+
+        view_layer.objects.active = obj
+        try:
+            bpy.ops.object.update_joint_locations('EXEC_DEFAULT')
+        except RuntimeError as error:
+            print(f"ERROR: Joint update of {name} failed: {error}")
+
+    view_layer.objects.active = previous_active
+    prune_joint_caches()
+    return None
+
+
+@contextmanager
+def suspend_joint_updates(defer=True):
+    # Suspends the coalesced joint updates, e.g. while a script changes many shape keys of many avatars.
+    # With defer=True the meshes that changed meanwhile are updated afterwards, with defer=False they are
+    # dropped because the caller updates the joint locations itself.
+    global _suspend_depth
+    _suspend_depth += 1
+    try:
+        yield
+    finally:
+        _suspend_depth -= 1
+        if (_suspend_depth == 0) and (not defer):
+            _dirty_objects.clear()
+
+
+@persistent
+def load_post(*args):
+    # Objects of the previous file are gone
+    prune_joint_caches()
+
+
+def register_handlers():
+    if load_post not in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.append(load_post)
+
+
+def unregister_handlers():
+    if load_post in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(load_post)
+
+
+def clear():
+    if bpy.app.timers.is_registered(update_dirty_objects):
+        bpy.app.timers.unregister(update_dirty_objects)
+
+    _dirty_objects.clear()
@@ -0,0 +1,283 @@
+# Cache of the avatar templates from the model .blend files.
+#
+# Appending an avatar reads the whole model file with all shape keys and pose correctives from disk.
+# Instead, every (SMPL version, gender) model is appended only once into a collection which is not linked
+# to any scene, and new avatars are created by duplicating the cached datablocks. The cache only lives for the
+# session: it is removed before the .blend file is saved, since the templates with all their shape keys would
+# make every saved file much larger, and it is rebuilt on first use. The collection has a fake user while it
+# exists, otherwise undo and orphan purges would drop it.
+#
+# For crowds, avatars can also share their mesh: the body shape is baked into a mesh without shape keys
+# once per unique set of betas, and all avatars with the same betas use that mesh and armature data.
+import bpy
+from bpy.app.handlers import persistent
+import hashlib
+import numpy as np
+import os
+import re
+
+from .blender import (
+    key_block_coordinates,
+    key_block_indices,
+    pack_body_model,
+    set_joint_locations,
+)
+from .body_model import (
+    body_model_path,
+    cache_body_model,
+    load_body_model,
+    save_body_model,
+)
+from .globals import (
+    MODEL_JOINT_NAMES,
+    PATH,
+    SMPLX_MODELFILE,
+    SMPLH_MODELFILE,
+    SUPR_MODELFILE,
+)
+from .regressors import (
+    load_betas_to_joints,
+)
+
+TEMPLATE_COLLECTION_NAME = "SMPL Templates"
+TEMPLATE_SUFFIX = ".template"
+
+MODEL_FILES = {
+    'SMPLX': SMPLX_MODELFILE,
+    'SUPR': SUPR_MODELFILE,
+    'SMPLH': SMPLH_MODELFILE,
+}
+
+
+def template_object_name(SMPL_version, gender):
+    # Name of the mesh object in the model .blend file, e.g. "SUPR-mesh-male"
+    return SMPL_version + "-mesh-" + gender
+
+
+def get_template_collection():
+    collection = bpy.data.collections.get(TEMPLATE_COLLECTION_NAME)
+    if collection is None:
+        collection = bpy.data.collections.new(name=TEMPLATE_COLLECTION_NAME)
+        collection.use_fake_user = True
+    return collection
+
+
+def remove_templates():
+    # Removes the template collection with its objects and their data. Avatars own copies of the data.
+    collection = bpy.data.collections.get(TEMPLATE_COLLECTION_NAME)
+    if collection is None:
+        return
+
+    objects = list(collection.objects)
+    data = [obj.data for obj in objects if obj.data is not None]
+    bpy.data.batch_remove(objects + data + [collection])
+
+
+@persistent
+def save_pre(*args):
+    # Saved files do not contain the template cache, see remove_templates()
+    remove_templates()
+
+
+def register_handlers():
+    if save_pre not in bpy.app.handlers.save_pre:
+        bpy.app.handlers.save_pre.append(save_pre)
+
+
+def unregister_handlers():
+    if save_pre in bpy.app.handlers.save_pre:
+        bpy.app.handlers.save_pre.remove(save_pre)
+
+
+def find_template(SMPL_version, gender):
+    # Returns the cached template mesh object or None. The template is looked up by name on every call
+    # instead of keeping a reference, which would become invalid after undo or loading another file.
+    collection = bpy.data.collections.get(TEMPLATE_COLLECTION_NAME)
+    if collection is None:
+        return None
+
+    obj = collection.objects.get(template_object_name(SMPL_version, gender) + TEMPLATE_SUFFIX)
+    if (obj is None) or (obj.type != 'MESH') or (obj.parent is None) or (obj.parent.type != 'ARMATURE'):
+        return None
+
+    return obj
+
+
+def load_template(SMPL_version, gender):
+    # Appends the mesh and its armature from the model file into the template collection
+    if SMPL_version not in MODEL_FILES:
+        raise ValueError(f"Unsupported SMPL version: {SMPL_version}")
+
+    model_path = os.path.join(PATH, "data", MODEL_FILES[SMPL_version])
+    object_name = template_object_name(SMPL_version, gender)
+
+    with bpy.data.libraries.load(model_path, link=False) as (data_from, data_to):
+        if object_name not in data_from.objects:
+            raise ValueError(f"No object {object_name} in {model_path}")
+        data_to.objects = [object_name]
+
+    # Loading the mesh object also loads its dependencies, including the parent armature
+    obj = data_to.objects[0]
+    armature = obj.parent
+
+    # Appended names get a numeric suffix if the file already contains objects with the same name
+    collection = get_template_collection()
+    for template in (armature, obj):
+        template.name = re.sub(r"\.\d{3,}$", "", template.name) + TEMPLATE_SUFFIX
+        collection.objects.link(template)
+
+    return obj
+
+
+def get_template(SMPL_version, gender):
+    obj = find_template(SMPL_version, gender)
+    if obj is None:
+        obj = load_template(SMPL_version, gender)
+    return obj
+
+
+def instantiate_template(template, collection):
+    # Duplicates a template armature and mesh into the given collection and returns the new mesh object.
+    # Mesh and armature data are copied, so shape keys and joint locations can be changed per avatar.
+    template_armature = template.parent
+
+    armature = template_armature.copy()
+    armature.data = template_armature.data.copy()
+    armature.name = template_armature.name[:-len(TEMPLATE_SUFFIX)]
+
+    obj = template.copy()
+    obj.data = template.data.copy()
+    obj.name = template.name[:-len(TEMPLATE_SUFFIX)]
+    obj.parent = armature
+
+    for modifier in obj.modifiers:
+        if (modifier.type == 'ARMATURE') and (modifier.object == template_armature):
+            modifier.object = armature
+
+    # Materials stay shared, setting a texture assigns another shared material instead of editing this one
+    collection.objects.link(armature)
+    collection.objects.link(obj)
+
+    return obj
+
+
+def betas_digest(SMPL_version, gender, betas):
+    # Hash of a body shape. Trailing zero betas do not change the shape, so they are not part of the hash.
+    betas = np.trim_zeros(np.asarray(betas, dtype=np.float32).ravel(), 'b')
+    digest = hashlib.sha1(f"{SMPL_version}-{gender}-".encode())
+    digest.update(betas.tobytes())
+    return digest.hexdigest()[:16]
+
+
+def bake_shape(mesh, betas):
+    # Returns the (num_vertices, 3) vertex coordinates of the Shape### key blocks applied with the given betas
+    key = mesh.shape_keys
+    key_blocks = key.key_blocks
+
+    basis = key_block_coordinates(key.reference_key)
+    coordinates = basis.astype(np.float64)
+
+    shape_coordinates = None
+    for (index, beta) in zip(key_block_indices(key, "Shape"), betas):
+        if beta != 0.0:
+            shape_coordinates = key_block_coordinates(key_blocks[int(index)], out=shape_coordinates)
+            coordinates += beta * (shape_coordinates - basis)
+
+    return coordinates
+
+
+def get_shared_mesh(template, SMPL_version, gender, betas):
+    # Returns the mesh of the template with the body shape baked in and without any shape keys.
+    # Meshes are created once per unique body shape and shared by all avatars with that shape.
+    digest = betas_digest(SMPL_version, gender, betas)
+    name = template_object_name(SMPL_version, gender) + "-" + digest
+
+    mesh = bpy.data.meshes.get(name)
+    if (mesh is not None) and (mesh.get("betas_digest") == digest):
+        return mesh
+
+    coordinates = bake_shape(template.data, betas)
+
+    mesh = template.data.copy()
+    mesh.name = name
+    mesh["betas_digest"] = digest
+    mesh["betas"] = [float(beta) for beta in np.trim_zeros(np.asarray(betas, dtype=np.float64), 'b')]
+
+    # Shape keys can only be removed through an object
+    temporary_object = bpy.data.objects.new(name, mesh)
+    temporary_object.shape_key_clear()
+    bpy.data.objects.remove(temporary_object)
+
+    mesh.vertices.foreach_set("co", coordinates.astype(np.float32).ravel())
+    mesh.update()
+
+    return mesh
+
+
+def set_shared_shape(obj, SMPL_version, gender, betas):
+    # Gives a shared mesh avatar the body shape of the betas. Mesh and armature data are shared with all
+    # other avatars with the same shape, the armature object (and so the action) stays per avatar.
+    armature = obj.parent
+    template = get_template(SMPL_version, gender)
+
+    num_betas = len(key_block_indices(template.data.shape_keys, "Shape"))
+    shape_betas = np.zeros(num_betas)
+    shape_betas[:min(num_betas, len(betas))] = np.asarray(betas, dtype=np.float64).ravel()[:num_betas]
+
+    obj.data = get_shared_mesh(template, SMPL_version, gender, shape_betas)
+
+    digest = obj.data["betas_digest"]
+    armature_data = bpy.data.armatures.get(obj.data.name)
+    if (armature_data is not None) and (armature_data.get("betas_digest") == digest):
+        armature.data = armature_data
+        return obj
+
+    armature.data = template.parent.data.copy()
+    armature.data.name = obj.data.name
+    armature.data["betas_digest"] = digest
+
+    # SMPLH has no joint regressor, its avatars keep the template joint locations
+    (betas_to_joints, template_j) = load_betas_to_joints(SMPL_version, gender, num_betas)
+    if betas_to_joints is not None:
+        joint_locations = betas_to_joints @ shape_betas + template_j
+        set_joint_locations(armature, MODEL_JOINT_NAMES[SMPL_version].value, joint_locations, SMPL_version)
+
+    return obj
+
+
+def instantiate_shared_template(template, collection, SMPL_version, gender, betas):
+    # Like instantiate_template(), but the new avatar uses the shared mesh and armature data of its body shape
+    template_armature = template.parent
+
+    armature = template_armature.copy()
+    armature.name = template_armature.name[:-len(TEMPLATE_SUFFIX)]
+
+    obj = template.copy()
+    obj.name = template.name[:-len(TEMPLATE_SUFFIX)]
+    obj.parent = armature
+
+    for modifier in obj.modifiers:
+        if (modifier.type == 'ARMATURE') and (modifier.object == template_armature):
+            modifier.object = armature
+
+    # Armature has to be in the scene before its joints can be edited
+    collection.objects.link(armature)
+    collection.objects.link(obj)
+
+    return set_shared_shape(obj, SMPL_version, gender, betas)
+
+
+def get_body_model(SMPL_version, gender):
+    # Returns the NumPy body model of a template. The first call packs it from the template mesh and
+    # saves it to the data folder, later sessions load the packed file directly.
+    model = load_body_model(SMPL_version, gender)
+    if model is not None:
+        return model
+
+    model = pack_body_model(get_template(SMPL_version, gender), SMPL_version, gender)
+    try:
+        save_body_model(body_model_path(SMPL_version, gender), model)
+    except OSError as error:
+        print(f"WARNING: Could not save packed body model: {error}")
+
+    return cache_body_model(model)
@@ -27,6 +27,7 @@ class SMPL_PT_Create(bpy.types.Panel):
         split = row.split(factor=0.75, align=True)
         split.prop(context.window_manager.smpl_tool, "texture")
         split.operator("object.set_texture", text="Set")
+        col.prop(context.window_manager.smpl_tool, "texture_resolution")
 
 
 class SMPL_PT_Load(bpy.types.Panel):
@@ -162,7 +163,8 @@ class SMPL_PT_Export(bpy.types.Panel):
         col.prop(context.window_manager.smpl_tool, "export_setting_shape_keys")
 
         col.separator()
-        col.operator("object.export_unity_fbx")
+        col.operator("object.export_avatar")
+        col.operator("object.export_glb")
 
 
 class SMPL_PT_AdditionalTools(bpy.types.Panel):
@@ -197,6 +199,6 @@ UI_CLASSES = [
     SMPL_PT_Shape,
     SMPL_PT_Pose,
     SMPL_PT_Expression,
-    # SMPL_PT_Export,  # this just doesn't seem that necissary and it's taking up space in the UI
+    SMPL_PT_Export,
     SMPL_PT_AdditionalTools,
 ]
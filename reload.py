@@ -6,9 +6,18 @@ addon_name = "meshcapade"
 module = "meshcapade_addon"
 parts_to_reload = [
     "blender",
+    "body_model",
+    "correctives",
     "globals",
+    "gltf",
+    "materials",
+    "motion",
     "operators",
     "properties",
+    "regressors",
+    "rotations",
+    "scheduler",
+    "templates",
     "meshcapade_addon",
     "ui",
 ]
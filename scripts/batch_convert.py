@@ -0,0 +1,90 @@
+# Converts .npz motion files to .fbx or .obj in a background Blender instance.
+#
+# usage: blender -b -P scripts/batch_convert.py -- --input <.npz, directory or manifest> [...] --output-dir <dir>
+#
+# The addon must be installed in Blender, see --addon for its module name.
+import argparse
+import importlib
+import sys
+
+import addon_utils
+
+
+def parse_args():
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+
+    parser = argparse.ArgumentParser(prog="blender -b -P batch_convert.py --", description="Convert .npz motion files to .fbx/.obj")
+    parser.add_argument("--input", nargs="+", required=True, help=".npz files, directories or manifests (.txt, .json, .jsonl)")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--format", choices=("fbx", "obj"), default="fbx")
+    parser.add_argument("--results", help="append one json line per converted file to this file")
+    parser.add_argument("--skip-existing", action="store_true", help="do not convert files whose output already exists")
+    parser.add_argument("--addon", default="meshcapade", help="module name of the installed addon")
+
+    # OP_LoadAvatar options
+    parser.add_argument("--smpl-version", choices=("SMPLX", "SMPLH", "SUPR"), default="SMPLX")
+    parser.add_argument("--anim-format", choices=("AMASS", "blender"), default="AMASS")
+    parser.add_argument("--gender-override", choices=("disabled", "female", "male", "neutral"), default="disabled")
+    parser.add_argument("--hand-pose", choices=("disabled", "relaxed", "flat"), default="disabled")
+    parser.add_argument("--target-framerate", type=int, default=30)
+    parser.add_argument("--pose-correctives", action="store_true", help="keyframe the corrective pose weights")
+    parser.add_argument("--reduce-keyframes", action="store_true")
+    parser.add_argument("--streaming-chunk-size", type=int, default=0)
+    parser.add_argument("--ground-snapping", choices=("CURRENT", "CONSTANT", "PER_FRAME"), default="CURRENT")
+
+    # Export options
+    parser.add_argument("--shape-keys", choices=("SHAPE_POSE", "SHAPE", "NONE"), default="SHAPE_POSE")
+    parser.add_argument("--keep-unused-shape-keys", action="store_true", help="also export shape keys which are zero and not animated")
+    parser.add_argument("--export-profile", choices=("DEFAULT", "UNITY", "UNREAL"), default="DEFAULT")
+    parser.add_argument("--bake-step", type=float, default=1.0)
+    parser.add_argument("--simplify", type=float, default=1.0)
+
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+
+    addon_utils.enable(args.addon, default_set=True)
+    batch = importlib.import_module(f"{args.addon}.meshcapade_addon.batch")
+    manifest = importlib.import_module(f"{args.addon}.meshcapade_addon.manifest")
+
+    load_options = {
+        "SMPL_version": args.smpl_version,
+        "anim_format": args.anim_format,
+        "gender_override": args.gender_override,
+        "hand_pose": args.hand_pose,
+        "target_framerate": args.target_framerate,
+        "keyframe_corrective_pose_weights": args.pose_correctives,
+        "reduce_keyframes": args.reduce_keyframes,
+        "streaming_chunk_size": args.streaming_chunk_size,
+        "ground_snapping": args.ground_snapping,
+    }
+
+    export_options = {
+        "shape_keys": args.shape_keys,
+        "strip_unused": not args.keep_unused_shape_keys,
+        "profile": args.export_profile,
+        "bake_step": args.bake_step,
+        "simplify": args.simplify,
+    }
+
+    inputs = manifest.collect_inputs(args.input)
+    print(f"Converting {len(inputs)} files to {args.format}")
+
+    results = batch.convert_files(
+        inputs,
+        args.output_dir,
+        export_type=args.format,
+        load_options=load_options,
+        export_options=export_options,
+        skip_existing=args.skip_existing,
+        results_path=args.results,
+    )
+
+    num_failed = sum(1 for result in results if result["status"] == "failed")
+    print(f"Finished: {len(results) - num_failed} converted or skipped, {num_failed} failed")
+    sys.exit(1 if num_failed else 0)
+
+
+main()
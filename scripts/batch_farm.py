@@ -0,0 +1,161 @@
+# Converts a large motion corpus with several background Blender instances in parallel.
+#
+# usage: python scripts/batch_farm.py --input <folder or manifest> [...] --output-dir <dir> --workers 64 [-- <batch_convert.py options>]
+#
+# The corpus is split into one shard per worker, balanced by the number of frames of each file. Every worker
+# runs scripts/batch_convert.py on its shard and writes one result line per file into the work folder.
+# Running the same command again resumes: files that were already converted are skipped, files that
+# failed are only retried with --retry-failed.
+import argparse
+import glob
+import heapq
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import time
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+batch_convert_script = os.path.join(script_dir, "batch_convert.py")
+
+# manifest.py has no Blender dependencies, load it directly from the addon folder
+manifest_spec = importlib.util.spec_from_file_location(
+    "manifest", os.path.join(script_dir, "..", "meshcapade_addon", "manifest.py")
+)
+manifest = importlib.util.module_from_spec(manifest_spec)
+manifest_spec.loader.exec_module(manifest)
+
+
+def parse_args():
+    argv = sys.argv[1:]
+    worker_args = []
+    if "--" in argv:
+        worker_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+
+    parser = argparse.ArgumentParser(description="Convert .npz motion files with parallel background Blender instances")
+    parser.add_argument("--input", nargs="+", required=True, help=".npz files, directories or manifests (.txt, .json, .jsonl)")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--format", choices=("fbx", "obj"), default="fbx")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--blender", default="blender", help="Blender executable")
+    parser.add_argument("--work-dir", help="folder for shard manifests, results and logs (default: <output-dir>/.batch_farm)")
+    parser.add_argument("--retry-failed", action="store_true", help="convert files again that failed in a previous run")
+    args = parser.parse_args(argv)
+
+    args.worker_args = worker_args
+    if args.work_dir is None:
+        args.work_dir = os.path.join(args.output_dir, ".batch_farm")
+    return args
+
+
+def read_results(work_dir):
+    # Latest result per input file over all previous runs
+    results = {}
+    for results_path in sorted(glob.glob(os.path.join(work_dir, "*.results.jsonl"))):
+        with open(results_path) as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    results[result["input"]] = result
+    return results
+
+
+def read_results_file(results_path):
+    converted = set()
+    if os.path.exists(results_path):
+        with open(results_path) as f:
+            converted = {json.loads(line)["input"] for line in f if line.strip()}
+    return converted
+
+
+def frame_count(input_path):
+    try:
+        return manifest.npz_num_frames(input_path)
+    except Exception:
+        # Unreadable files still get converted (and fail) in a worker, give them a small weight
+        return 1
+
+
+def make_shards(inputs, num_workers):
+    # Longest processing time first: assign the longest remaining file to the least loaded shard
+    weighted_inputs = sorted(((frame_count(path), (path, root)) for (path, root) in inputs), reverse=True)
+
+    shards = [[] for _ in range(num_workers)]
+    loads = [(0, index) for index in range(num_workers)]
+    for (num_frames, entry) in weighted_inputs:
+        (load, index) = heapq.heappop(loads)
+        shards[index].append(entry)
+        heapq.heappush(loads, (load + num_frames, index))
+
+    return [(shard, load) for ((load, index), shard) in zip(sorted(loads, key=lambda item: item[1]), shards) if shard]
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    inputs = manifest.collect_inputs(args.input)
+    previous_results = read_results(args.work_dir)
+
+    done_status = ("ok", "skipped") if args.retry_failed else ("ok", "skipped", "failed")
+    pending = [
+        (path, root) for (path, root) in inputs
+        if previous_results.get(path, {}).get("status") not in done_status
+    ]
+    print(f"{len(inputs)} files, {len(inputs) - len(pending)} done in previous runs, {len(pending)} to convert")
+
+    run_id = time.strftime("%Y%m%d_%H%M%S")
+    workers = []
+    for (shard_index, (shard, num_frames)) in enumerate(make_shards(pending, max(1, args.workers))):
+        name = os.path.join(args.work_dir, f"{run_id}_shard{shard_index:03d}")
+        manifest.write_manifest(name + ".jsonl", shard)
+
+        command = [
+            args.blender, "-b", "-noaudio", "-P", batch_convert_script, "--",
+            "--input", name + ".jsonl",
+            "--output-dir", args.output_dir,
+            "--format", args.format,
+            "--results", name + ".results.jsonl",
+        ] + args.worker_args
+
+        print(f"Starting worker {shard_index}: {len(shard)} files, {num_frames} frames")
+        log = open(name + ".log", "w")
+        workers.append((subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT), log, name, shard))
+
+    for (process, log, name, shard) in workers:
+        return_code = process.wait()
+        log.close()
+
+        if return_code not in (0, 1):
+            # Blender crashed. The first file without result is the likely cause, record it as failed so that
+            # resuming does not crash on it again. The remaining files of the shard stay pending.
+            converted = read_results_file(name + ".results.jsonl")
+            for (path, root) in shard:
+                if path not in converted:
+                    result = {
+                        "input": path,
+                        "output": manifest.output_path_for(path, root, args.output_dir, args.format),
+                        "status": "failed",
+                        "error": f"Blender exited with code {return_code}, see {name}.log",
+                    }
+                    with open(name + ".results.jsonl", "a") as f:
+                        f.write(json.dumps(result) + "\n")
+                    break
+
+    results = read_results(args.work_dir)
+    summary = {}
+    for (path, _) in inputs:
+        status = results.get(path, {}).get("status", "pending")
+        summary[status] = summary.get(status, 0) + 1
+
+    with open(os.path.join(args.work_dir, "results.json"), "w") as f:
+        json.dump([results[path] for (path, _) in inputs if path in results], f, indent=1)
+
+    print("Finished: " + ", ".join(f"{count} {status}" for (status, count) in sorted(summary.items())))
+    sys.exit(0 if set(summary) <= {"ok", "skipped"} else 1)
+
+
+if __name__ == "__main__":
+    main()